@@ -17,23 +17,30 @@ from discord.ext import tasks
 from discord import app_commands
 from discord.ext import commands
 
-import io
 import math
+import mmap
 import uuid
+import random
+import socket
 import functools
+import contextlib
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 
 import requests
 from requests.adapters import HTTPAdapter
-from requests_toolbelt import MultipartEncoder, StreamingIterator
 from tqdm import tqdm
 import concurrent.futures
 from urllib3.util.retry import Retry
 from os import rename
-from subprocess import run
 from bs4 import BeautifulSoup
+import json
+import hashlib
+import sqlite3
 import tempfile
+import threading
+import collections
+from zipfile import ZipFile, ZIP_DEFLATED
 
 
 if len(sys.argv) > 3:
@@ -43,11 +50,20 @@ if len(sys.argv) > 3:
     GUILD_ID = int(sys.argv[2])
     # 第三引数: 許可ユーザーIDのカンマ区切りリスト（例: 12345,67890）
     authorized_list = [int(x) for x in sys.argv[3].split(",") if x]
+    # 第四引数(任意): 同時に処理するジョブ数
+    WORKER_NUM = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+    # 第五引数(任意): 作業ディレクトリの容量上限(GB)
+    WORKSPACE_QUOTA_GB = float(sys.argv[5]) if len(sys.argv) > 5 else 50
+    # 第六引数(任意): ダウンロード済みファイルのキャッシュ容量(GB)、0で無効
+    MEDIA_CACHE_GB = float(sys.argv[6]) if len(sys.argv) > 6 else 20
 else:
     config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'YTDdisco.config')
     TOKEN = None
     GUILD_ID = None
     authorized_list = []
+    WORKER_NUM = 2
+    WORKSPACE_QUOTA_GB = 50
+    MEDIA_CACHE_GB = 20
     if os.path.exists(config_path):
         with open(config_path, encoding='utf-8') as f:
             for line in f:
@@ -57,15 +73,1038 @@ else:
                     GUILD_ID = int(line.strip().split('=', 1)[1])
                 elif line.strip().startswith('AUTHORIZED='):
                     authorized_list = [int(x) for x in line.strip().split('=', 1)[1].split(",") if x]
+                elif line.strip().startswith('WORKERS='):
+                    WORKER_NUM = int(line.strip().split('=', 1)[1])
+                elif line.strip().startswith('WORKSPACE_QUOTA_GB='):
+                    WORKSPACE_QUOTA_GB = float(line.strip().split('=', 1)[1])
+                elif line.strip().startswith('MEDIA_CACHE_GB='):
+                    MEDIA_CACHE_GB = float(line.strip().split('=', 1)[1])
     if TOKEN is None or GUILD_ID is None:
         raise RuntimeError('TOKENまたはGUILD_IDが指定されていません。コマンドライン引数またはYTDdisco.configを用意してください。')
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
+# 保存先（ジョブ・キャッシュ・アップロード再開用のDB、変換済みファイルのキャッシュ、作業ディレクトリ）
+DB_PATH = os.path.join(parent_dir, 'YTDdisco.db')
+MEDIA_CACHE_DIR = os.path.join(parent_dir, 'YTD_cache')
+WORKSPACE_DIR = os.path.join(tempfile.gettempdir(), 'YTD_temp')
+
+# URL展開キャッシュの有効期限・件数上限と、差分更新で取得する先頭の件数
+RESOLVE_CACHE_TTL = 6 * 60 * 60
+RESOLVE_CACHE_MAX_ENTRIES = 1000
+RESOLVE_REFRESH_PAGE = 50
+# 展開結果をキャッシュするプレイリストの項目数の上限（超えるものはキャッシュしない）
+RESOLVE_CACHE_MAX_URLS = 5000
+# 入力URLを同時に解決する数
+RESOLVE_CONCURRENCY = 4
+# プレイリスト展開時に先読みしておく項目数と、ダウンロード待ちで保持するアイテム数
+RESOLVE_PAGE_SIZE = 100
+STREAM_WINDOW_SIZE = 64
+
+# 途中まで取得したアイテムを続きから取得できるように残しておく期間
+PARTIAL_MAX_AGE = 24 * 60 * 60
+# 作業ディレクトリの容量上限で次のダウンロードを待つ最長時間
+QUOTA_WAIT_TIMEOUT = 30 * 60
+# gigafileへの途中までのアップロードを続きから送れるように残しておく期間
+GIGAFILE_RESUME_MAX_AGE = 24 * 60 * 60
+
+# 同時ダウンロード数（bot全体・ジョブごと・サイトごと）
+DOWNLOAD_CONCURRENCY = 6
+JOB_DOWNLOAD_CONCURRENCY = 4
+# zipfile=False時、ダウンロード済みでアップロード待ちにしておけるアイテム数
+UPLOAD_BUFFER_SIZE = 2
+SITE_DOWNLOAD_CONCURRENCY = {
+    'youtube': 4,
+    'soundcloud': 4,
+    'nicovideo': 2,  # aria2c自体が多重接続するので少なめ
+    'abema.tv': 1,
+    'gigafile.nu': 2,
+}
+
+# オプションの組み合わせごとに待機させておくYoutubeDLの数
+YDL_POOL_MAX_IDLE = 8
+
+# 後処理（変換・エンコード）のffmpegを同時に動かす数
+POSTPROCESS_WORKERS = os.cpu_count() or 1
+
+# 常駐aria2cのRPCポートと設定（分割数・接続数・帯域はここで調整する）
+# ポートは0なら空いているものを使う。既定の6800は他のaria2cと衝突しやすいので固定しない
+ARIA2_RPC_PORT = 0
+ARIA2_OPTIONS = {
+    'max-concurrent-downloads': '4',
+    'split': '16',
+    'max-connection-per-server': '16',
+    'min-split-size': '1M',
+    'max-overall-download-limit': '0',
+}
+
+# gigafileへ同時に送るチャンク数
+GIGAFILE_UPLOAD_THREADS = 4
+# 順番待ち中にキャンセルを確認する間隔(秒)
+GIGAFILE_CANCEL_CHECK_INTERVAL = 0.5
+# チャンクの再送回数と、再送までの待ち時間(指数的に増やし上限で止め、ランダムにずらす)
+GIGAFILE_CHUNK_RETRIES = 8
+GIGAFILE_RETRY_BASE_DELAY = 1
+GIGAFILE_RETRY_MAX_DELAY = 60
+# チャンクの再送でも失敗したとき、アップロード全体を続きからやり直す回数
+GIGAFILE_UPLOAD_ATTEMPTS = 3
+# アップロード先サーバーを調べ直すまでの時間(秒)
+GIGAFILE_SERVER_TTL = 30 * 60
+
+
+class JobCancelled(yt_dlp.utils.DownloadCancelled):
+    """ジョブがキャンセルされたことを示す"""
+    msg = 'ジョブがキャンセルされました'
+
+
+class InfoHookPP(yt_dlp.postprocessor.PostProcessor):
+    """後処理の段階に来た情報をフックに渡すだけの後処理"""
+    def __init__(self, hooks: dict) -> None:
+        super().__init__()
+        self.hooks = hooks
+
+    def run(self, info: dict) -> tuple[list, dict]:
+        if self.hooks['info'] is not None:
+            self.hooks['info'](dict(info))
+        return [], info
+
+
+class YoutubeDLPool:
+    """オプションの組み合わせごとにYoutubeDLインスタンスを使い回すプール
+
+    抽出器の初期化やHTTPセッション・Cookieの作成を毎回やり直さないようにする。
+    outtmplとprogress/postprocessor/infoフックは貸し出しごとに差し替える。
+    """
+    def __init__(self, max_idle: int) -> None:
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle: dict[str, list[tuple[yt_dlp.YoutubeDL, dict]]] = {}
+
+    def create(self, options: dict) -> tuple[yt_dlp.YoutubeDL, dict]:
+        hooks = {'progress': None, 'postprocessor': None, 'info': None}
+
+        def progress_hook(d: dict) -> None:
+            if hooks['progress'] is not None:
+                hooks['progress'](d)
+
+        def postprocessor_hook(d: dict) -> None:
+            if hooks['postprocessor'] is not None:
+                hooks['postprocessor'](d)
+
+        ydl = yt_dlp.YoutubeDL({
+            **options,
+            'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [postprocessor_hook],
+        })
+        ydl.add_post_processor(InfoHookPP(hooks), when='post_process')
+        return ydl, hooks
+
+    @contextlib.contextmanager
+    def checkout(self, options: dict, outtmpl: Optional[str] = None, progress_hook: Optional[Callable] = None, postprocessor_hook: Optional[Callable] = None, info_hook: Optional[Callable] = None):
+        key = json.dumps(options, sort_keys=True, default=repr)
+        with self.lock:
+            idle = self.idle.get(key)
+            entry = idle.pop() if idle else None
+        if entry is None:
+            entry = self.create(options)
+
+        ydl, hooks = entry
+        hooks['progress'] = progress_hook
+        hooks['postprocessor'] = postprocessor_hook
+        hooks['info'] = info_hook
+        default_outtmpl = ydl.params['outtmpl']['default']
+        if outtmpl is not None:
+            ydl.params['outtmpl']['default'] = outtmpl
+        try:
+            yield ydl
+        finally:
+            hooks['progress'] = None
+            hooks['postprocessor'] = None
+            hooks['info'] = None
+            ydl.params['outtmpl']['default'] = default_outtmpl
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(entry)
+                    entry = None
+            if entry is not None:
+                ydl.close()
+
+
+ydl_pool = YoutubeDLPool(YDL_POOL_MAX_IDLE)
+
+
+# 音声変換時のエンコーダー（コピーできない場合）
+AUDIO_ENCODERS = {
+    'mp3': ['-c:a', 'libmp3lame'],
+    'm4a': ['-c:a', 'aac'],
+    'flac': ['-c:a', 'flac'],
+    'wav': ['-c:a', 'pcm_s16le'],
+}
+
+
+def metadata_args(info: dict) -> list[str]:
+    """yt-dlpのFFmpegMetadataと同じ項目を -metadata の引数にする"""
+    tags = {
+        'title': info.get('track') or info.get('title'),
+        'artist': info.get('artist') or info.get('creator') or info.get('uploader') or info.get('uploader_id'),
+        'album': info.get('album'),
+        'date': info.get('release_date') or info.get('upload_date'),
+        'description': info.get('description'),
+        'comment': info.get('webpage_url'),
+    }
+    args = []
+    for key, value in tags.items():
+        if value:
+            args += ['-metadata', f'{key}={value}']
+    return args
+
+
+def one_pass_command(options: dict, transcode_args: Optional[list[str]], info: dict) -> Optional[Tuple[list[str], str, Optional[str]]]:
+    """音声変換・タグ付け・カバー画像の埋め込み（mp4では再エンコードも）を1回で行うffmpegの
+
+    (出力先を除いた引数, 出力先, 埋め込むカバー画像) を返す。後処理が無ければNone
+    """
+    postprocessors = {pp['key']: pp for pp in options.get('postprocessors', [])}
+    extract_audio = postprocessors.get('FFmpegExtractAudio')
+    add_metadata = postprocessors.get('FFmpegMetadata', {}).get('add_metadata', False)
+    filepath = info['filepath']
+    thumbnail = next((t['filepath'] for t in reversed(info.get('thumbnails') or []) if t.get('filepath') and os.path.exists(t['filepath'])), None)
+
+    if extract_audio is None and not (add_metadata or thumbnail or transcode_args):
+        return None
+
+    args = ['ffmpeg', '-y', '-loglevel', 'error', '-i', filepath]
+    if thumbnail:
+        args += ['-i', thumbnail]
+
+    if extract_audio is not None:
+        ext = extract_audio['preferredcodec']
+        args += ['-map', '0:a:0']
+        if (info.get('acodec') or '').startswith(AUDIO_CODEC_PREFIXES.get(ext, ())):
+            args += ['-c:a', 'copy']
+        else:
+            args += AUDIO_ENCODERS[ext]
+            if ext in ('mp3', 'm4a'):
+                args += ['-b:a', f'{extract_audio.get("preferredquality", "192")}k']
+        if thumbnail and ext != 'wav':
+            args += ['-map', '1:v:0', '-c:v', 'mjpeg', '-disposition:v:0', 'attached_pic']
+        if ext == 'mp3':
+            args += ['-id3v2_version', '3']
+    else:
+        ext = info['ext']
+        args += ['-map', '0', '-c', 'copy']
+        if transcode_args:
+            # カバー画像のストリームは再エンコードの対象にしない
+            args += ['-c:v:0' if arg == '-c:v' else arg for arg in transcode_args]
+        if thumbnail:
+            args += ['-map', '1:v:0', '-c:v:1', 'mjpeg', '-disposition:v:1', 'attached_pic']
+
+    if add_metadata:
+        args += metadata_args(info)
+
+    return args, f'{os.path.splitext(filepath)[0]}.{ext}', thumbnail
+
+
+def run_ydl_postprocessors(options: dict, info: dict) -> dict:
+    """1回でまとめて処理できなかった場合に、yt-dlpの後処理を順に行う"""
+    with yt_dlp.YoutubeDL(options) as ydl:
+        return ydl.post_process(info['filepath'], info)
+
+
+postprocess_slots = asyncio.Semaphore(POSTPROCESS_WORKERS)
+
+
+# コーデック指定ごとに、再エンコードせずに使える映像・音声のコーデック名の先頭
+VIDEO_CODEC_PREFIXES = {
+    'h264': ('avc1', 'h264'),
+    'h265': ('hvc1', 'hev1', 'h265', 'hevc'),
+    'vp9': ('vp09', 'vp9'),
+    'av1': ('av01',),
+}
+AUDIO_CODEC_PREFIXES = {
+    'm4a': ('mp4a', 'aac'),
+    'mp3': ('mp3',),
+    'flac': ('flac',),
+}
+
+
+# サイズ見積もり用の1秒あたりのバイト数と、長さが分からない場合の1アイテムの秒数
+ESTIMATED_BYTE_RATE = {
+    'audio': 24_000,
+    'worst': 15_000,
+    '144': 15_000,
+    '240': 30_000,
+    '360': 60_000,
+    '480': 120_000,
+    '720': 300_000,
+    '1080': 600_000,
+    '1440': 1_500_000,
+    '2160': 3_000_000,
+    'best': 600_000,
+}
+ESTIMATED_DURATION = 240
+# この秒数以上待ったジョブはサイズに関係なく先に処理する（飢餓防止）
+AGING_SECONDS = 30 * 60
+# 展開キャッシュの無いプレイリスト・チャンネルは先頭のこの件数だけ取得して見積もる
+ESTIMATE_PROBE_ENTRIES = 50
+# 展開キャッシュを引くときのURLの種類と状態
+FLAT_STATES = {'youtube_playlist': 'playlist', 'youtube_channel': 'channel'}
+
+
+def estimated_byte_rate(extension: str, resolution: str) -> int:
+    if extension != 'mp4':
+        return ESTIMATED_BYTE_RATE['audio']
+    return ESTIMATED_BYTE_RATE.get(resolution, ESTIMATED_BYTE_RATE['best'])
+
+
+# (種類, パターン, 正規化URLのテンプレート)
+# 上から順に照合し、最初にマッチしたものを使う。group(1)がID
+URL_RULES = [
+    ('nicovideo', re.compile(r'((?:sm|so|nm)\d+)$'), 'https://www.nicovideo.jp/watch/{}'),
+    ('youtube', re.compile(r'([A-Za-z0-9_-]{11})$'), 'https://www.youtube.com/watch?v={}'),
+    ('youtube', re.compile(r'(?:https?://)?(?:www\.|m\.|music\.)?youtube\.com/watch/?\?(?:[^#]*?&)?v=([A-Za-z0-9_-]{11})'), 'https://www.youtube.com/watch?v={}'),
+    ('youtube', re.compile(r'(?:https?://)?(?:www\.|m\.|music\.)?youtube\.com/(?:shorts|live|embed|v)/([A-Za-z0-9_-]{11})'), 'https://www.youtube.com/watch?v={}'),
+    ('youtube', re.compile(r'(?:https?://)?youtu\.be/([A-Za-z0-9_-]{11})'), 'https://www.youtube.com/watch?v={}'),
+    ('youtube_playlist', re.compile(r'(?:https?://)?(?:www\.|m\.|music\.)?youtube\.com/playlist/?\?(?:[^#]*?&)?list=([A-Za-z0-9_-]+)'), 'https://www.youtube.com/playlist?list={}'),
+    ('youtube_channel', re.compile(r'(?:https?://)?(?:www\.|m\.)?youtube\.com/((?:@|channel/|c/|user/)[^/?#]+(?:/(?:videos|shorts|streams|playlists))?)'), 'https://www.youtube.com/{}'),
+    ('nicovideo', re.compile(r'(?:https?://)?(?:www\.|sp\.)?nicovideo\.jp/watch/((?:sm|so|nm)\d+)'), 'https://www.nicovideo.jp/watch/{}'),
+    ('nicovideo', re.compile(r'(?:https?://)?nico\.ms/((?:sm|so|nm)\d+)'), 'https://www.nicovideo.jp/watch/{}'),
+    ('nicovideo_mylist', re.compile(r'(?:https?://)?(?:www\.|sp\.)?nicovideo\.jp/((?:user/\d+/)?mylist/\d+)'), 'https://www.nicovideo.jp/{}'),
+    ('soundcloud_short', re.compile(r'(?:https?://)?on\.soundcloud\.com/([A-Za-z0-9]+)'), 'https://on.soundcloud.com/{}'),
+    ('soundcloud', re.compile(r'(?:https?://)?(?:www\.|m\.)?soundcloud\.com/([^?#]+?)/?(?:[?#]|$)'), 'https://soundcloud.com/{}'),
+    ('gigafile', re.compile(r'(?:https?://)?(\d+\.gigafile\.nu/[a-z0-9-]+)'), 'https://{}'),
+    ('other', re.compile(r'(https?://[^#\s]+)'), '{}'),
+]
+COLLECTION_KINDS = ('youtube_playlist', 'youtube_channel', 'nicovideo_mylist')
+
+
+@functools.lru_cache(maxsize=65536)
+def canonicalize_url(url: str) -> Optional[Tuple[str, str, str]]:
+    """入力を (種類, 重複判定用のキー, 正規化したURL) に変換する。対応していない入力はNone"""
+    for kind, pattern, template in URL_RULES:
+        m = pattern.match(url)
+        if m:
+            ident = m.group(1)
+            return kind, f'{kind}:{ident}', template.format(ident)
+    return None
+
+
+def is_collection_url(url: str) -> bool:
+    """プレイリスト・チャンネルなど複数アイテムに展開されるURLかどうか"""
+    canonical = canonicalize_url(url)
+    if canonical is None:
+        return False
+    kind, key, url = canonical
+    if kind == 'soundcloud':
+        # ユーザーページとセットは複数トラックに展開される
+        return '/' not in key.split(':', 1)[1] or '/sets/' in url
+    return kind in COLLECTION_KINDS or kind == 'soundcloud_short'
+
+
+# 解決段階からダウンロード段階へ引き継ぐフラット抽出の項目
+ENTRY_METADATA_KEYS = ('title', 'duration', 'filesize_approx')
+
+
+def entry_metadata(entry: dict) -> dict:
+    """フラット抽出の項目から引き継ぐメタデータだけを取り出す"""
+    return {key: entry[key] for key in ENTRY_METADATA_KEYS if entry.get(key) is not None}
+
+
+def estimate_job_size(txt_content: str, extension: str, resolution: str) -> Tuple[int, int]:
+    """ジョブのアイテム数と合計バイト数を見積もる
+
+    プレイリスト・チャンネルは展開キャッシュがあればそれを使い、無ければ先頭ESTIMATE_PROBE_ENTRIES件から全体を推定する。
+    """
+    rate = estimated_byte_rate(extension, resolution)
+    items = 0
+    total = 0
+    ydl_opts = {
+        'quiet': True,
+        'extract_flat': True,
+        'skip_download': True,
+        'playlistend': ESTIMATE_PROBE_ENTRIES,
+    }
+    with ydl_pool.checkout(ydl_opts) as ydl:
+        for url in txt_content.split():
+            if not is_collection_url(url):
+                items += 1
+                total += rate * ESTIMATED_DURATION
+                continue
+            kind, key, url = canonicalize_url(url)
+            state = FLAT_STATES.get(kind)
+            cached = resolve_cache.get(f'flat_{state}', url)[0] if state else None
+            if cached is not None:
+                info = cached.get('info', {})
+                entries = [info.get(entry_url, {}) for entry_url in cached['urls']]
+                count = len(entries)
+            else:
+                try:
+                    info_dict = ydl.extract_info(url, download=False)
+                except Exception:
+                    items += 1
+                    total += rate * ESTIMATED_DURATION
+                    continue
+                entries = list(info_dict.get('entries') or [])
+                # 先頭だけ取得したので、全体の件数が分かればその分まで延ばす
+                count = max(len(entries), info_dict.get('playlist_count') or 0)
+            sizes = [entry.get('filesize_approx') or int((entry.get('duration') or ESTIMATED_DURATION) * rate) for entry in entries]
+            items += count
+            if sizes:
+                total += sum(sizes) * count // len(sizes)
+    return items, total
+
+
+class DownloadQueue:
+    """ユーザーごとに公平に、各ユーザーの中では見積もりサイズの小さいジョブを優先して取り出すダウンロードキュー
+
+    優先レーンのジョブを除き、取り出した回数の少ないユーザーから順に選ぶ。
+    ユーザーの中では、AGING_SECONDS以上待ったジョブ、見積もりサイズの小さいジョブの順に選ぶ。
+    取り出した回数が同じユーザーの間ではその順序で比べ、それでも同じならラウンドロビン順にする。
+    """
+    def __init__(self) -> None:
+        self.user_queues: dict[int, collections.deque] = {}
+        self.user_order: collections.deque[int] = collections.deque()
+        # キューにいる間にユーザーごとに取り出した回数
+        self.served: dict[int, int] = {}
+        self.condition = asyncio.Condition()
+
+    def qsize(self) -> int:
+        return sum(len(q) for q in self.user_queues.values())
+
+    def sort_key(self, modal_data: dict, now: float) -> tuple:
+        """小さいほど先に処理される"""
+        if modal_data.get('priority'):
+            return (0, modal_data['queued_at'])
+        waited = now - modal_data['queued_at']
+        if waited >= AGING_SECONDS:
+            return (1, modal_data['queued_at'])
+        # 待つほど見積もりサイズを割り引く
+        return (2, modal_data['cost'] * (1 - waited / AGING_SECONDS))
+
+    def pick(self, user_queues: dict[int, collections.deque], user_order: collections.deque, served: dict[int, int], now: float) -> Tuple[int, dict]:
+        best = None
+        for rank, user_id in enumerate(user_order):
+            modal_data = min(user_queues[user_id], key=lambda d: self.sort_key(d, now))
+            # 大量の小さいジョブで他のユーザーを待たせないよう、取り出した回数を先に比べる
+            key = (not modal_data.get('priority'), served[user_id], self.sort_key(modal_data, now), rank)
+            if best is None or key < best[0]:
+                best = (key, user_id, modal_data)
+        return best[1], best[2]
+
+    def take(self, user_queues: dict[int, collections.deque], user_order: collections.deque, served: dict[int, int], now: float) -> dict:
+        user_id, modal_data = self.pick(user_queues, user_order, served, now)
+        user_queues[user_id].remove(modal_data)
+        # 取り出したユーザーは末尾に回す
+        user_order.remove(user_id)
+        if user_queues[user_id]:
+            user_order.append(user_id)
+            served[user_id] += 1
+        else:
+            del user_queues[user_id]
+            del served[user_id]
+        return modal_data
+
+    def iter_order(self):
+        """次に取り出される順番でジョブを列挙する"""
+        user_queues = {user_id: collections.deque(q) for user_id, q in self.user_queues.items()}
+        user_order = collections.deque(self.user_order)
+        served = dict(self.served)
+        now = time.time()
+        while user_order:
+            yield self.take(user_queues, user_order, served, now)
+
+    def position(self, modal_data: dict) -> int:
+        for i, data in enumerate(self.iter_order()):
+            if data is modal_data:
+                return i + 1
+        return 0
+
+    async def put(self, modal_data: dict) -> int:
+        user_id = modal_data['user'].id
+        async with self.condition:
+            if user_id not in self.user_queues:
+                # 新しく並んだユーザーは、今いるユーザーの中で一番少ない回数から始める
+                self.served[user_id] = min(self.served.values(), default=0)
+                self.user_queues[user_id] = collections.deque()
+                self.user_order.append(user_id)
+            self.user_queues[user_id].append(modal_data)
+            self.condition.notify()
+        return self.position(modal_data)
+
+    async def get(self) -> dict:
+        async with self.condition:
+            await self.condition.wait_for(lambda: len(self.user_order) > 0)
+            return self.take(self.user_queues, self.user_order, self.served, time.time())
+
+    async def remove(self, job_id: str) -> Optional[dict]:
+        """待機中のジョブをキューから取り除く"""
+        async with self.condition:
+            for user_id in list(self.user_order):
+                for modal_data in self.user_queues[user_id]:
+                    if modal_data['job_id'] == job_id:
+                        self.user_queues[user_id].remove(modal_data)
+                        if not self.user_queues[user_id]:
+                            del self.user_queues[user_id]
+                            del self.served[user_id]
+                            self.user_order.remove(user_id)
+                        return modal_data
+        return None
+
+class Workspace:
+    """1ジョブ分の作業ディレクトリ"""
+    def __init__(self, job_id: str, path: str, keep: bool = False) -> None:
+        self.job_id = job_id
+        self.path = path
+        self.keep = keep  # Trueなら終了後も削除しない
+        self.uploads_dir = os.path.join(path, 'uploads')
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    def item_dir(self, key) -> str:
+        """アイテムごとのダウンロード先"""
+        if self.keep:
+            return os.path.join(self.path, 'downloads', str(key))
+        return os.path.join(self.path, 'items', str(key))
+
+
+class WorkspaceManager:
+    """ジョブごとの作業ディレクトリと全体の容量上限を管理する"""
+    def __init__(self, root: str, quota: int) -> None:
+        self.root = root
+        self.quota = quota
+        self.workspaces: dict[str, Workspace] = {}
+        self.cleanup_tasks: set[asyncio.Task] = set()
+        # 途中まで取得したアイテムの置き場所。ジョブや再起動をまたいで同じアイテムは同じ場所になる
+        self.partial_root = os.path.join(root, '_partial')
+        self.partial_locks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def create(self, job_id: str, path: Optional[str] = None, keep: bool = False) -> Workspace:
+        workspace = Workspace(job_id, path or os.path.join(self.root, job_id), keep=keep)
+        self.workspaces[job_id] = workspace
+        return workspace
+
+    def directory_size(self, path: str) -> int:
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return total
+
+    def freeable_size(self, workspace: Workspace) -> int:
+        """他のジョブが使っている容量のうち、待てば空く分（取得中・アップロード待ちのアイテム）"""
+        total = 0
+        for other in list(self.workspaces.values()):
+            if other is workspace or other.keep:
+                continue
+            # uploads内はzipにするためジョブが終わるまで残るので、待っても空かない
+            total += self.directory_size(other.path) - self.directory_size(other.uploads_dir)
+        # 途中のアイテムは取得中のものだけ。残っているだけのものは待っても消えない
+        with self.lock:
+            active = [name for name, lock in self.partial_locks.items() if lock.locked()]
+        for name in active:
+            total += self.directory_size(os.path.join(self.partial_root, name))
+        return total
+
+    async def wait_for_quota(self, workspace: Workspace) -> None:
+        """容量が上限を超えている間は、他のジョブの取得中のアイテムが片付くまで次のダウンロードを待つ
+
+        ジョブ同士が待ち合って止まらないよう、一番古いジョブは待たず、待つのもQUOTA_WAIT_TIMEOUTまでにする。
+        """
+        deadline = time.monotonic() + QUOTA_WAIT_TIMEOUT
+        while True:
+            usage = await asyncio.to_thread(self.directory_size, self.root)
+            if usage < self.quota:
+                return
+            if next((w for w in self.workspaces.values() if not w.keep), None) is workspace:
+                return
+            if await asyncio.to_thread(self.freeable_size, workspace) <= 0:
+                return
+            if time.monotonic() >= deadline:
+                logging.warning(f'YTD: 容量の空き待ちが{QUOTA_WAIT_TIMEOUT}秒を超えたため続行します - {workspace.job_id}')
+                return
+            await asyncio.sleep(5)
+
+    def cleanup(self, path: str, deleter: Optional[Callable[[str], None]] = None) -> None:
+        """削除をスレッドに投げてすぐに戻る"""
+        deleter = deleter or functools.partial(shutil.rmtree, ignore_errors=True)
+        task = asyncio.create_task(asyncio.to_thread(deleter, path))
+        self.cleanup_tasks.add(task)
+        task.add_done_callback(self.cleanup_tasks.discard)
+
+    def release(self, workspace: Workspace, deleter: Callable[[str], None]) -> None:
+        self.workspaces.pop(workspace.job_id, None)
+        if not workspace.keep:
+            self.cleanup(workspace.path, deleter)
+
+    def cleanup_orphans(self, keep: tuple = ()) -> None:
+        """前回の実行で残った作業ディレクトリを削除する"""
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name in self.workspaces or name in keep or os.path.join(self.root, name) == self.partial_root:
+                continue
+            self.cleanup(os.path.join(self.root, name))
+
+    def partial_dir(self, key: str) -> str:
+        return os.path.join(self.partial_root, hashlib.sha256(key.encode()).hexdigest())
+
+    def partial_lock(self, key: str) -> threading.Lock:
+        """同じアイテムを複数のジョブが同時に取得しないためのロック"""
+        name = os.path.basename(self.partial_dir(key))
+        with self.lock:
+            return self.partial_locks.setdefault(name, threading.Lock())
+
+    def last_modified(self, path: str) -> float:
+        latest = os.path.getmtime(path)
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                try:
+                    latest = max(latest, os.path.getmtime(os.path.join(root, file)))
+                except OSError:
+                    pass
+        return latest
+
+    def cleanup_stale_partials(self, max_age: float) -> None:
+        """max_age秒以上更新されていない途中のダウンロードを削除する"""
+        if not os.path.isdir(self.partial_root):
+            return
+        now = time.time()
+        for name in os.listdir(self.partial_root):
+            lock = self.partial_locks.get(name)
+            if lock is not None and lock.locked():
+                continue
+            path = os.path.join(self.partial_root, name)
+            try:
+                if now - self.last_modified(path) > max_age:
+                    self.cleanup(path)
+            except OSError:
+                pass
+
+class FlatPlaylist:
+    """ダウンロードしながら項目を取得するプレイリスト・チャンネル"""
+    def __init__(self, url: str, state: str, strip_suffix: Optional[str] = None) -> None:
+        self.url = url
+        self.state = state
+        self.strip_suffix = strip_suffix
+        self.name: Optional[str] = None
+
+    def set_name(self, name: Optional[str]) -> None:
+        if name and self.strip_suffix and name.endswith(self.strip_suffix):
+            name = name[:-len(self.strip_suffix)].rstrip()
+        self.name = name
+
+    def __repr__(self) -> str:
+        return f'FlatPlaylist({self.url!r}, {self.state!r})'
+
+
+class DownloadLimiter:
+    """全体とサイトごとの同時ダウンロード数を制限する"""
+    def __init__(self, total: int, site_limits: dict[str, int], default_limit: int) -> None:
+        self.total = asyncio.Semaphore(total)
+        self.site_limits = site_limits
+        self.sites = {site: asyncio.Semaphore(limit) for site, limit in site_limits.items()}
+        self.default = asyncio.Semaphore(default_limit)
+
+    def site_of(self, url: str) -> Optional[str]:
+        for site in self.site_limits:
+            if site in url:
+                return site
+        return None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url: str):
+        site = self.site_of(url)
+        async with self.sites.get(site, self.default), self.total:
+            yield
+
+
+class Aria2Daemon:
+    """常駐させたaria2cにJSON-RPCでダウンロードさせる
+
+    ファイルごとにaria2cを起動せず、分割数・接続数・帯域の上限はここでまとめて設定する。
+    """
+    def __init__(self, port: int, options: dict[str, str]) -> None:
+        # 0なら起動のたびに空いているポートを選ぶ
+        self.port = port
+        self.rpc_port = port
+        self.options = options
+        self.secret = uuid.uuid4().hex
+        self.process: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+
+    def available(self) -> bool:
+        return shutil.which('aria2c') is not None
+
+    def call(self, method: str, *params) -> Any:
+        payload = {
+            'jsonrpc': '2.0',
+            'id': uuid.uuid4().hex,
+            'method': f'aria2.{method}',
+            'params': [f'token:{self.secret}', *params],
+        }
+        r = self.session.post(f'http://127.0.0.1:{self.rpc_port}/jsonrpc', json=payload, timeout=10)
+        result = r.json()
+        if 'error' in result:
+            raise RuntimeError(f'aria2: {result["error"].get("message")}')
+        return result['result']
+
+    def free_port(self) -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def wait_rpc(self) -> bool:
+        """起動したaria2cのRPCが応答するまで待つ。起動に失敗したか、別のプロセスが応答した場合はFalse"""
+        for _ in range(50):
+            if self.process.poll() is not None:
+                # ポートが使われていたなどで終了した
+                return False
+            try:
+                self.call('getVersion')
+                return True
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.2)
+            except RuntimeError:
+                # 秘密鍵が通らないのは、同じポートで別のaria2cが待ち受けている
+                return False
+        return False
+
+    def ensure_started(self) -> None:
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            # 空いているポートを選んでから起動するまでに他に取られることがあるので、数回選び直す
+            for _ in range(3 if self.port == 0 else 1):
+                self.rpc_port = self.port or self.free_port()
+                self.process = subprocess.Popen(self.command())
+                if self.wait_rpc():
+                    return
+                with contextlib.suppress(ProcessLookupError):
+                    self.process.kill()
+                self.process.wait()
+            raise RuntimeError(f'aria2cのRPCに接続できませんでした (port {self.rpc_port})')
+
+    def command(self) -> list[str]:
+        args = [
+            'aria2c',
+            '--enable-rpc',
+            '--rpc-listen-all=false',
+            f'--rpc-listen-port={self.rpc_port}',
+            f'--rpc-secret={self.secret}',
+            f'--stop-with-process={os.getpid()}',
+            '--continue=true',
+            '--auto-file-renaming=false',
+            '--allow-overwrite=true',
+            '--console-log-level=warn',
+        ]
+        args.extend(f'--{key}={value}' for key, value in self.options.items())
+        return args
+
+    def download(self, url: str, path: str, headers: dict[str, str], modal: 'OptionModal') -> str:
+        """pathにダウンロードし、終わるまで進捗をmodal.progress_contentに書き込む"""
+        self.ensure_started()
+        # 制御ファイルが無く本体があれば取得済み
+        if os.path.isfile(path) and not os.path.isfile(path + '.aria2'):
+            return path
+        gid = self.call('addUri', [url], {
+            'dir': os.path.dirname(path),
+            'out': os.path.basename(path),
+            'header': [f'{key}: {value}' for key, value in headers.items()],
+        })
+        try:
+            while True:
+                if modal.cancelled.is_set():
+                    self.call('remove', gid)
+                    modal.check_cancelled()
+                status = self.call('tellStatus', gid, ['status', 'totalLength', 'completedLength', 'downloadSpeed', 'errorMessage'])
+                total = int(status['totalLength'])
+                completed = int(status['completedLength'])
+                speed = int(status['downloadSpeed'])
+                if total:
+                    eta = (total - completed) // speed if speed else 0
+                    modal.progress_content = f'{completed / total * 100:.1f}% of {round(completed/1048576, 2)}/{round(total/1048576, 2)} MiB at  {round(speed/1048576, 2)}MiB/s  ETA {eta//60:02d}:{eta%60:02d}'
+                if status['status'] == 'complete':
+                    return path
+                if status['status'] in ('error', 'removed'):
+                    raise yt_dlp.utils.DownloadError(f'aria2: {status.get("errorMessage")}')
+                time.sleep(0.5)
+        finally:
+            with contextlib.suppress(Exception):
+                self.call('removeDownloadResult', gid)
+
+
+class SQLiteStore:
+    """YTDdisco.dbに保存するクラスの共通部分。接続はスレッド間で共有し、lockで排他する"""
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+
+
+class JobStore(SQLiteStore):
+    """キュー内のジョブと完了済みアイテムをSQLiteに保存し、再起動後に再開できるようにする"""
+    job_fields = ('zipfile', 'codec', 'extension', 'resolution', 'thumbnail', 'metadata', 'options', 'txt_content')
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            channel_id INTEGER,
+            guild_id INTEGER,
+            params TEXT,
+            created REAL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS job_items (
+            job_id TEXT,
+            item_key TEXT,
+            paths TEXT,
+            PRIMARY KEY (job_id, item_key))''')
+
+    def add_job(self, modal_data: dict) -> None:
+        params = {key: modal_data[key] for key in self.job_fields}
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                (modal_data['job_id'], modal_data['user'].id, modal_data['channel'].id,
+                 modal_data['guild'].id if modal_data['guild'] else None, json.dumps(params), time.time()))
+
+    def remove_job(self, job_id: str) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM job_items WHERE job_id = ?', (job_id,))
+            self.conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+    def mark_item_done(self, job_id: str, item_key: str, paths: list[str]) -> None:
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO job_items VALUES (?, ?, ?)', (job_id, item_key, json.dumps(paths)))
+
+    def done_items(self, job_id: str) -> dict[str, list[str]]:
+        """完了済みアイテムと、zip用に移動済みのファイル(作業ディレクトリからの相対パス)"""
+        with self.lock:
+            rows = self.conn.execute('SELECT item_key, paths FROM job_items WHERE job_id = ?', (job_id,)).fetchall()
+        return {item_key: json.loads(paths) for item_key, paths in rows}
+
+    def pending_jobs(self) -> list[tuple]:
+        with self.lock:
+            return self.conn.execute('SELECT job_id, user_id, channel_id, guild_id, params FROM jobs ORDER BY created').fetchall()
+
+class ResolveCache(SQLiteStore):
+    """プレイリスト・チャンネル展開結果のTTL付きキャッシュ（SQLite、件数上限でLRU削除）"""
+    def __init__(self, path: str, ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        super().__init__(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS resolve_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            fetched_at REAL,
+            last_used REAL)''')
+
+    def normalize(self, url: str) -> str:
+        url = url.strip().rstrip('/')
+        scheme, _, rest = url.partition('://')
+        host, _, path = rest.partition('/')
+        return f'{scheme.lower()}://{host.lower()}/{path}'
+
+    def get(self, kind: str, url: str) -> Tuple[Any, bool]:
+        """(キャッシュされた値, TTL内かどうか) を返す。無ければ (None, False)"""
+        key = f'{kind}:{self.normalize(url)}'
+        with self.lock:
+            row = self.conn.execute('SELECT value, fetched_at FROM resolve_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None, False
+            self.conn.execute('UPDATE resolve_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0]), time.time() - row[1] < self.ttl
+
+    def put(self, kind: str, url: str, value: Any) -> None:
+        key = f'{kind}:{self.normalize(url)}'
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO resolve_cache VALUES (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+            # 最近使われていないものから上限を超えた分を削除
+            self.conn.execute('''DELETE FROM resolve_cache WHERE key IN (
+                SELECT key FROM resolve_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+
+class MediaCache(SQLiteStore):
+    """変換済みファイルのキャッシュ（メディアID・フォーマット設定ごと、容量上限でLRU削除）
+
+    ファイルはroot以下にキーのハッシュ名のディレクトリで保存し、ジョブの作業ディレクトリへはハードリンクで渡す。
+    """
+    def __init__(self, path: str, root: str, budget: int) -> None:
+        self.root = root
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS media_cache (
+            key TEXT PRIMARY KEY,
+            files TEXT,
+            size INTEGER,
+            last_used REAL)''')
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest())
+
+    def link(self, src: str, dst: str) -> None:
+        try:
+            os.link(src, dst)
+        except OSError:
+            # 別ドライブなどリンクできない場合はコピーする
+            shutil.copy2(src, dst)
+
+    def get(self, key: str, dest_dir: str) -> bool:
+        """キャッシュにあればdest_dirへリンクしてTrueを返す"""
+        if self.budget <= 0:
+            return False
+        entry_dir = self.entry_dir(key)
+        with self.lock:
+            row = self.conn.execute('SELECT files FROM media_cache WHERE key = ?', (key,)).fetchone()
+            if row is None or not all(os.path.isfile(os.path.join(entry_dir, name)) for name in json.loads(row[0])):
+                if row is not None:
+                    # ファイルが消えていれば登録ごと捨てる
+                    self.conn.execute('DELETE FROM media_cache WHERE key = ?', (key,))
+                self.misses += 1
+                return False
+            self.conn.execute('UPDATE media_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        names = json.loads(row[0])
+        os.makedirs(dest_dir, exist_ok=True)
+        try:
+            for name in names:
+                self.link(os.path.join(entry_dir, name), os.path.join(dest_dir, name))
+        except OSError:
+            # 渡している間にput・evictでエントリが消された場合は、途中まで渡したものを消してミスとして扱う
+            for name in names:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(dest_dir, name))
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def put(self, key: str, src_dir: str) -> None:
+        """src_dir内のファイルをキャッシュに登録する"""
+        if self.budget <= 0 or not os.path.isdir(src_dir):
+            return
+        names = sorted(name for name in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, name)))
+        size = sum(os.path.getsize(os.path.join(src_dir, name)) for name in names)
+        if not names or size > self.budget:
+            return
+
+        # 同じアイテムを同時に登録しても壊れないよう、一時ディレクトリに作ってから差し替える
+        entry_dir = self.entry_dir(key)
+        temp_dir = f'{entry_dir}.{uuid.uuid4().hex}'
+        os.makedirs(temp_dir)
+        for name in names:
+            self.link(os.path.join(src_dir, name), os.path.join(temp_dir, name))
+        with self.lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(temp_dir, entry_dir)
+            self.conn.execute('INSERT OR REPLACE INTO media_cache VALUES (?, ?, ?, ?)', (key, json.dumps(names), size, time.time()))
+            self.evict()
+
+    def evict(self) -> None:
+        """容量上限を超えた分を最近使われていないものから削除する（lock取得済みで呼ぶ）"""
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM media_cache').fetchone()[0]
+        if total <= self.budget:
+            return
+        for key, size in self.conn.execute('SELECT key, size FROM media_cache ORDER BY last_used').fetchall():
+            self.conn.execute('DELETE FROM media_cache WHERE key = ?', (key,))
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+            if total <= self.budget:
+                break
+
+    def stats(self) -> str:
+        with self.lock:
+            count, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media_cache').fetchone()
+        return f'キャッシュ: {count}件 {size / 1024**3:.1f}/{self.budget / 1024**3:.1f}GB ヒット {self.hits} / ミス {self.misses}'
+
+
+class GigaUploadStore(SQLiteStore):
+    """gigafileへのアップロードのトークンと受け付け済みチャンクをSQLiteに保存し、失敗・再起動後に続きから送れるようにする
+
+    ファイルはパスではなく内容(サイズと先頭チャンクのハッシュ)で識別し、チャンクごとのハッシュも残して再開前に照合する。
+    アップロード中の記録はclaimで確保し、同じファイルを同時に送る別のアップロードには使わせない。
+    """
+    def __init__(self, path: str, max_age: float) -> None:
+        self.max_age = max_age
+        super().__init__(path)
+        self.active: set[str] = set()
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS giga_uploads (
+            upload_key TEXT PRIMARY KEY,
+            token TEXT,
+            server TEXT,
+            chunk_size INTEGER,
+            chunks INTEGER,
+            created REAL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS giga_upload_chunks (
+            upload_key TEXT,
+            chunk_no INTEGER,
+            digest TEXT,
+            PRIMARY KEY (upload_key, chunk_no))''')
+
+    def get(self, upload_key: str) -> Optional[Tuple[str, str, int, int, dict[int, str]]]:
+        """(トークン, サーバー, チャンクサイズ, チャンク数, {チャンク番号: ハッシュ}) を返す。無いか古ければNone"""
+        with self.lock:
+            row = self.conn.execute('SELECT token, server, chunk_size, chunks, created FROM giga_uploads WHERE upload_key = ?', (upload_key,)).fetchone()
+            if row is None or time.time() - row[4] > self.max_age:
+                return None
+            digests = dict(self.conn.execute('SELECT chunk_no, digest FROM giga_upload_chunks WHERE upload_key = ?', (upload_key,)).fetchall())
+        return row[0], row[1], row[2], row[3], digests
+
+    def claim(self, upload_key: str) -> bool:
+        """記録を使う権利を確保する。他のアップロードが使用中ならFalse"""
+        with self.lock:
+            if upload_key in self.active:
+                return False
+            self.active.add(upload_key)
+            return True
+
+    def release(self, upload_key: str) -> None:
+        with self.lock:
+            self.active.discard(upload_key)
+
+    def start(self, upload_key: str, token: str, server: str, chunk_size: int, chunks: int) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM giga_upload_chunks WHERE upload_key = ?', (upload_key,))
+            self.conn.execute('INSERT OR REPLACE INTO giga_uploads VALUES (?, ?, ?, ?, ?, ?)', (upload_key, token, server, chunk_size, chunks, time.time()))
+
+    def ack(self, upload_key: str, chunk_no: int, digest: str) -> None:
+        with self.lock:
+            # 後続のチャンクで完了・削除された後に遅れて届いた記録は残さない
+            self.conn.execute('''INSERT OR REPLACE INTO giga_upload_chunks SELECT ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM giga_uploads WHERE upload_key = ?)''', (upload_key, chunk_no, digest, upload_key))
+
+    def remove(self, upload_key: str) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM giga_upload_chunks WHERE upload_key = ?', (upload_key,))
+            self.conn.execute('DELETE FROM giga_uploads WHERE upload_key = ?', (upload_key,))
+
+    def cleanup(self) -> None:
+        """期限切れのアップロードを削除する"""
+        with self.lock:
+            self.conn.execute('''DELETE FROM giga_upload_chunks WHERE upload_key IN (
+                SELECT upload_key FROM giga_uploads WHERE created < ?)''', (time.time() - self.max_age,))
+            self.conn.execute('DELETE FROM giga_uploads WHERE created < ?', (time.time() - self.max_age,))
+
+
 # キューシステム用のグローバル変数
-download_queue = asyncio.Queue()
-is_processing = False
-queue_processor_task = None
+download_queue = DownloadQueue()
+queue_worker_tasks: list[asyncio.Task] = []
+download_limiter = DownloadLimiter(DOWNLOAD_CONCURRENCY, SITE_DOWNLOAD_CONCURRENCY, default_limit=2)
+job_store = JobStore(DB_PATH)
+aria2_daemon = Aria2Daemon(ARIA2_RPC_PORT, ARIA2_OPTIONS)
+resolve_cache = ResolveCache(DB_PATH, RESOLVE_CACHE_TTL, RESOLVE_CACHE_MAX_ENTRIES)
+workspace_manager = WorkspaceManager(WORKSPACE_DIR, int(WORKSPACE_QUOTA_GB * 1024**3))
+media_cache = MediaCache(DB_PATH, MEDIA_CACHE_DIR, int(MEDIA_CACHE_GB * 1024**3))
+giga_upload_store = GigaUploadStore(DB_PATH, GIGAFILE_RESUME_MAX_AGE)
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -76,28 +1115,35 @@ class Main(commands.Cog):
     def __init__(self, bot: commands.Bot):
         print('login successful')
         self.bot = bot
-        self.current_modal = None
+        # ワーカー番号 -> 実行中のmodal
+        self.current_modals: dict[int, Optional[OptionModal]] = {i: None for i in range(WORKER_NUM)}
+        self.estimate_tasks: set[asyncio.Task] = set()
 
     async def start_queue_processor(self):
-        """キュープロセッサーを開始する"""
-        global queue_processor_task
-        if queue_processor_task is None or queue_processor_task.done():
-            queue_processor_task = asyncio.create_task(self.process_download_queue())
-            print("Queue processor started")
-
-    async def process_download_queue(self):
-        """キューからダウンロードタスクを順番に処理する"""
-        global is_processing
+        """キューワーカーを開始する"""
+        for worker_id in range(WORKER_NUM):
+            if worker_id < len(queue_worker_tasks):
+                if not queue_worker_tasks[worker_id].done():
+                    continue
+                queue_worker_tasks[worker_id] = asyncio.create_task(self.process_download_queue(worker_id))
+            else:
+                queue_worker_tasks.append(asyncio.create_task(self.process_download_queue(worker_id)))
+        print(f"Queue processor started ({WORKER_NUM} workers)")
+
+    def idle_worker_count(self) -> int:
+        return sum(1 for modal in self.current_modals.values() if modal is None)
+
+    def will_start_now(self) -> bool:
+        """今キューに追加したジョブがすぐに開始されるかどうか"""
+        return self.idle_worker_count() > download_queue.qsize()
+
+    async def process_download_queue(self, worker_id: int):
+        """キューからダウンロードタスクを取り出して処理する"""
         while True:
             try:
                 # キューから次のタスクを取得
                 modal_data = await download_queue.get()
 
-                if modal_data is None:  # 終了シグナル
-                    break
-
-                is_processing = True
-
                 # modalのインスタンスを作成して実行
                 modal = OptionModal(
                     bot=modal_data['bot'],
@@ -108,33 +1154,100 @@ class Main(commands.Cog):
                     thumbnail=modal_data['thumbnail'],
                     metadata=modal_data['metadata'],
                     options=modal_data['options'],
-                    txt_content=modal_data['txt_content']
+                    txt_content=modal_data['txt_content'],
+                    job_id=modal_data['job_id']
                 )
-                self.current_modal = modal
+                self.current_modals[worker_id] = modal
 
                 try:
-                    await modal.main_without_interaction(
+                    # /stopで個別にキャンセルできるようにタスクとして実行
+                    modal.job_task = asyncio.create_task(modal.main_without_interaction(
                         user=modal_data['user'],
                         channel=modal_data['channel'],
                         guild=modal_data['guild']
-                    )
+                    ))
+                    await modal.job_task
+                except asyncio.CancelledError:
+                    self.current_modals[worker_id] = None
+                    if not modal.cancelled.is_set():
+                        # /stop以外(botの終了)で止められた場合はジョブを残し、再起動後に再開する
+                        raise
                 except Exception as e:
                     print(f"ダウンロード処理中にエラーが発生しました: {e}")
                     traceback.print_exc()
-                finally:
-                    self.current_modal = None
-                    is_processing = False
-                    download_queue.task_done()
+                self.current_modals[worker_id] = None
+                # 完了・エラー・/stopのときだけ削除する。プロセスごと落ちた場合や終了時はここに来ないので、再起動後に再開される
+                job_store.remove_job(modal_data['job_id'])
+                workspace_manager.cleanup_stale_partials(PARTIAL_MAX_AGE)
 
             except Exception as e:
-                print(f"キュープロセッサーでエラーが発生しました: {e}")
-                is_processing = False
+                print(f"キュープロセッサー({worker_id})でエラーが発生しました: {e}")
+                self.current_modals[worker_id] = None
 
-    async def add_to_queue(self, modal_data):
+    async def add_to_queue(self, modal_data, persist: bool = True):
         """ダウンロードタスクをキューに追加"""
-        queue_size = download_queue.qsize()
-        await download_queue.put(modal_data)
-        return queue_size + 1  # キューの位置を返す
+        modal_data.setdefault('job_id', uuid.uuid4().hex[:8])
+        modal_data['queued_at'] = time.time()
+        # 許可ユーザーは priority オプションで優先レーンに入れる
+        modal_data['priority'] = 'priority' in modal_data['options'].split(',') and modal_data['user'].id in authorized_list
+        # 正確な見積もりが出るまでは行数から仮のサイズを使う
+        rate = estimated_byte_rate(modal_data['extension'], modal_data['resolution'])
+        modal_data['cost'] = len(modal_data['txt_content'].split()) * rate * ESTIMATED_DURATION
+        if persist:
+            job_store.add_job(modal_data)
+        # すぐに開始されるジョブは優先度を比べる必要がないので見積もらない
+        starts_now = self.will_start_now()
+        position = await download_queue.put(modal_data)  # キューの位置を返す
+        if starts_now:
+            return position
+
+        task = asyncio.create_task(self.estimate_cost(modal_data))
+        self.estimate_tasks.add(task)
+        task.add_done_callback(self.estimate_tasks.discard)
+        return position
+
+    async def estimate_cost(self, modal_data: dict) -> None:
+        """バックグラウンドでジョブのサイズを見積もり、キューの優先度に反映する"""
+        try:
+            items, size = await asyncio.to_thread(estimate_job_size, modal_data['txt_content'], modal_data['extension'], modal_data['resolution'])
+        except Exception as e:
+            print(f'サイズの見積もりに失敗しました: {e}')
+            return
+        modal_data['items'] = items
+        modal_data['cost'] = size
+
+    async def restore_queue(self) -> None:
+        """前回終了時に残っていたジョブをキューに戻す"""
+        for job_id, user_id, channel_id, guild_id, params in job_store.pending_jobs():
+            try:
+                user = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+                channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+            except discord.errors.HTTPException as e:
+                print(f'ジョブ {job_id} を復元できませんでした: {e}')
+                job_store.remove_job(job_id)
+                continue
+            modal_data = {
+                'bot': self.bot,
+                **json.loads(params),
+                'user': user,
+                'channel': channel,
+                'guild': self.bot.get_guild(guild_id) if guild_id else None,
+                'job_id': job_id,
+            }
+            await self.add_to_queue(modal_data, persist=False)
+            print(f'ジョブ {job_id} を再開します')
+
+    def queue_message(self, started: bool, queue_position: int) -> discord.Embed:
+        if started:
+            return discord.Embed(
+                description='ダウンロードを開始します...',
+                color=discord.Color.green()
+            )
+        return discord.Embed(
+            description=f'ダウンロードキューに追加されました。順番: {queue_position}番目\n'
+                        f'実行中のタスク({WORKER_NUM - self.idle_worker_count()}/{WORKER_NUM})のいずれかが完了次第開始されます。',
+            color=discord.Color.blue()
+        )
 
     @app_commands.command(name = 'dl', description = '動画ダウンロード')
     @app_commands.guilds(GUILD_ID)
@@ -194,20 +1307,11 @@ class Main(commands.Cog):
                     'channel': interaction.channel,
                     'guild': interaction.guild
                 }
+                started = self.will_start_now()
                 queue_position = await self.add_to_queue(modal_data)
 
-                if is_processing:
-                    embed = discord.Embed(
-                        description=f'ダウンロードキューに追加されました。順番: {queue_position}番目\n現在処理中のタスクが完了次第開始されます。',
-                        color=discord.Color.blue()
-                    )
-                    await interaction.followup.send(embed=embed, ephemeral=True)
-                else:
-                    embed = discord.Embed(
-                        description='ダウンロードを開始します...',
-                        color=discord.Color.green()
-                    )
-                    await interaction.followup.send(embed=embed, ephemeral=True)
+                embed = self.queue_message(started, queue_position)
+                await interaction.followup.send(embed=embed, ephemeral=True)
 
             except Exception as e:
                 embed = discord.Embed(
@@ -233,38 +1337,90 @@ class Main(commands.Cog):
     @app_commands.guilds(GUILD_ID)
     @app_commands.describe()
     async def progress_send(self, interaction: discord.Interaction,) -> Callable[[discord.Interaction], Awaitable[None]]:
-        if self.current_modal:
-            await self.current_modal.progress_send(interaction)
-        else:
+        running = [(worker_id, modal) for worker_id, modal in self.current_modals.items() if modal is not None]
+        if not running:
             embed = discord.Embed(
                 description = '現在実行中のダウンロードタスクがありません。',
                 color=discord.Color.red()
             )
             await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
 
-    @app_commands.command(name = 'stop', description = 'ダウンロードを停止(botの再起動)')
-    @app_commands.guilds(GUILD_ID)
-    @app_commands.describe()
-    async def stop_download(self, interaction: discord.Interaction,) -> Callable[[discord.Interaction], Awaitable[None]]:
+        # ワーカーごとの状態をまとめて表示
+        lines = [f'worker {worker_id + 1}: {modal.status_line()}' for worker_id, modal in running]
+        lines.append(f'待機中: {download_queue.qsize()}件')
+        lines.append(media_cache.stats())
         embed = discord.Embed(
-            description = f'{interaction.user.display_name} によりダウンロードが停止されました。',
-            color=discord.Color.dark_red()
+            title = f'[workers] {len(running)}/{WORKER_NUM}',
+            description = '\n'.join(lines),
+            color = discord.Color.dark_theme(),
         )
-        await interaction.response.send_message(embed=embed)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
 
-        python = sys.executable
-        os.execl(python, python, *sys.argv)
+        # 同じチャンネルで実行中のタスクは進捗メッセージを再送信
+        for worker_id, modal in running:
+            if getattr(modal, 'channel', None) is not None and modal.channel.id == interaction.channel.id:
+                await modal.progress_send(interaction.channel)
+
+    @app_commands.command(name = 'stop', description = 'ダウンロードを停止')
+    @app_commands.guilds(GUILD_ID)
+    @app_commands.describe(
+        job='停止するジョブID（省略時は実行中のすべてのジョブ）',
+        restart='botを再起動する',
+    )
+    async def stop_download(self, interaction: discord.Interaction, job: Optional[str] = None, restart: Optional[bool] = False) -> Callable[[discord.Interaction], Awaitable[None]]:
+        if restart:
+            embed = discord.Embed(
+                description = f'{interaction.user.display_name} によりダウンロードが停止されました。',
+                color=discord.Color.dark_red()
+            )
+            await interaction.response.send_message(embed=embed)
+
+            # 実行中のジョブは停止対象なので破棄し、待機中のジョブは再起動後に再開する
+            for modal in self.current_modals.values():
+                if modal is not None:
+                    job_store.remove_job(modal.job_id)
+
+            python = sys.executable
+            os.execl(python, python, *sys.argv)
+
+        stopped = []
+        for modal in self.current_modals.values():
+            if modal is not None and (job is None or modal.job_id == job):
+                modal.cancel()
+                stopped.append(modal.job_id)
+        if job is not None and not stopped and await download_queue.remove(job) is not None:
+            job_store.remove_job(job)
+            stopped.append(job)
+
+        if stopped:
+            embed = discord.Embed(
+                description = f'{interaction.user.display_name} によりダウンロードが停止されました。({", ".join(stopped)})',
+                color=discord.Color.dark_red()
+            )
+        else:
+            embed = discord.Embed(
+                description = '停止するダウンロードタスクがありません。',
+                color=discord.Color.red()
+            )
+        await interaction.response.send_message(embed=embed)
 
 class OptionModal(discord.ui.Modal):
-    def __init__(self, bot: commands.Bot, zipfile: bool = True, extension: str = 'mp3', codec: str = 'default', resolution: str = 'best', thumbnail: bool = True, metadata: bool = True, options: str = '', txt_content: str = None) -> None:
+    def __init__(self, bot: commands.Bot, zipfile: bool = True, extension: str = 'mp3', codec: str = 'default', resolution: str = 'best', thumbnail: bool = True, metadata: bool = True, options: str = '', txt_content: str = None, job_id: str = None) -> None:
         super().__init__(title='Input Download URL', timeout=None)
         self.zipfile = zipfile; self.extension = extension; self.codec = codec ;self.resolution = resolution; self.thumbnail = thumbnail; self.metadata = metadata; self.options = options.split(',')
         self.txt_content = txt_content
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.cancelled = threading.Event()
+        # キャンセル時にkillする実行中のサブプロセス（streamlink・ffmpeg）
+        self.processes: set[asyncio.subprocess.Process] = set()
+        self.job_task: Optional[asyncio.Task] = None
 
         '''
         limit: ダウンロード数制限を解除
         nvidia: GPUでエンコード
         dm: DMで実行
+        priority: 優先レーンで実行（許可ユーザーのみ）
         '''
 
         self.bot = bot
@@ -309,20 +1465,11 @@ class OptionModal(discord.ui.Modal):
             'guild': interaction.guild
         }
 
+        started = self.get_command_cog.will_start_now()
         queue_position = await self.get_command_cog.add_to_queue(modal_data)
 
-        if is_processing:
-            embed = discord.Embed(
-                description=f'ダウンロードキューに追加されました。順番: {queue_position}番目\n現在処理中のタスクが完了次第開始されます。',
-                color=discord.Color.blue()
-            )
-            await interaction.response.send_message(embed=embed)
-        else:
-            embed = discord.Embed(
-                description='ダウンロードを開始します...',
-                color=discord.Color.green()
-            )
-            await interaction.response.send_message(embed=embed, ephemeral=True)
+        embed = self.get_command_cog.queue_message(started, queue_position)
+        await interaction.response.send_message(embed=embed, ephemeral=started)
 
     async def main(self, interaction: discord.Interaction) -> Callable[[discord.Interaction], Awaitable[None]]:
         # TXTファイルから直接呼び出された場合の初期化処理
@@ -374,7 +1521,7 @@ class OptionModal(discord.ui.Modal):
                     self.msg = await interaction.followup.send(embed=embed, wait=True)
                 else:
                     self.msg = await interaction.channel.send(embed=embed,file=None)
-            except discord.errors.HTTPException as e:
+            except discord.errors.HTTPException:
                 # インタラクションに問題がある場合は通常のチャンネル送信にフォールバック
                 self.msg = await self.channel.send(embed=embed,file=None)
         self.edit_message.start()
@@ -382,121 +1529,7 @@ class OptionModal(discord.ui.Modal):
         # self.msg = await interaction.followup.send(content='[initializing]', wait=True, ephemeral=self.ephemeral)
 
         try:
-            temp_path = os.path.join(tempfile.gettempdir(), "YTD_temp")
-            self.delete_folder(temp_path)
-
-            uploads_dir = os.path.join(temp_path, 'uploads')
-            os.makedirs(uploads_dir)
-
-            self.input_url_list = self.url_input.value.split()
-            url_list, self.num = self.get_urllist(self.input_url_list)
-
-            if self.num > self.max_downloads:
-                embed = discord.Embed(
-                    description = f'一度にダウンロードできる最大ファイル数は {self.max_downloads} です。',
-                    )
-                await self.channel.send(embed=embed)
-                return
-
-            if len(url_list) == 0:
-                #await self.msg.edit(content='Invalid url error')
-                return
-            print(url_list)
-
-            self.cnt = 1
-            for item in url_list:
-                    self.status_content = '[downloading]'
-                    self.embed_color = discord.Color.brand_red()
-                    if type(item) is tuple:
-                        downloads_dir = os.path.join(temp_path, item[1])
-                        for url in item[0]:
-                            try:
-                                await asyncio.to_thread(self.download, downloads_dir, url, self.extension, self.resolution, self.thumbnail, self.metadata,)
-                            except Exception:
-                                traceback.print_exc()
-                            self.cnt += 1
-                        self.cnt -= 1
-                        self.status_content = '[making zip]'
-                        self.embed_color = discord.Color.yellow()
-
-                        if self.zipfile == False:
-                            self.status_content = f'[uploading] {self.cnt}/{self.num} : {item[1]}'
-                            self.embed_color = discord.Color.teal()
-                            await self.upload_file(downloads_dir, item)
-                            self.delete_folder(downloads_dir)
-                        else:
-                            shutil.move(downloads_dir, uploads_dir)
-                            # move後はdownloads_dirは存在しないので削除不要
-                        self.cnt += 1
-
-                    elif type(item) is str:
-                        downloads_dir = os.path.join(temp_path, 'downloads')
-                        try:
-                            await asyncio.to_thread(self.download, downloads_dir, item, self.extension, self.resolution, self.thumbnail, self.metadata)
-                        except Exception as e:
-                            print(f'ダウンロードエラー: {e}')
-                            traceback.print_exc()
-                        
-                        # ダウンロードディレクトリが存在し、ファイルがあるか確認
-                        if not os.path.exists(downloads_dir) or len(os.listdir(downloads_dir)) == 0:
-                            print(f'ダウンロード失敗またはファイルなし: {item}')
-                            self.cnt += 1
-                            continue
-                        
-                        download_path = os.path.join(downloads_dir, os.listdir(downloads_dir)[0])
-
-                        if self.zipfile == False:
-                            self.status_content = f'[uploading] {self.cnt}/{self.num} : {os.listdir(downloads_dir)[0]}'
-                            self.embed_color = discord.Color.teal()
-                            await self.upload_file(download_path, item)
-                        else:
-                            shutil.move(download_path, uploads_dir)
-
-                        self.cnt += 1
-                        self.delete_folder(downloads_dir)
-
-            # ダウンロードされたファイル数を確認し、1個のファイルなら圧縮せず送信、複数またはフォルダならzip化
-            if self.zipfile == True:
-                files = os.listdir(uploads_dir)
-                if len(files) == 1:
-                    file_path = os.path.join(uploads_dir, files[0])
-                    # フォルダの場合はzip化する
-                    if os.path.isdir(file_path):
-                        self.num = 1; self.cnt = 1
-                        self.status_content = '[making zip]'
-                        self.embed_color = discord.Color.yellow()
-                        zip_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        zip_base = os.path.join(temp_path, f'uploads_{zip_timestamp}')
-                        await asyncio.to_thread(shutil.make_archive, zip_base, 'zip', file_path)
-                        self.status_content = '[uploading] 1/1'
-                        self.embed_color = discord.Color.teal()
-                        uploadzip_dir = f'{zip_base}.zip'
-                        await self.upload_file(uploadzip_dir, self.input_url_list)
-                    else:
-                        self.num = 1; self.cnt = 1
-                        self.status_content = '[uploading] 1/1'
-                        self.embed_color = discord.Color.teal()
-                        await self.upload_file(file_path, self.input_url_list)
-                elif len(files) > 1:
-                    self.num = 1; self.cnt = 1
-                    self.status_content = '[making zip]'
-                    self.embed_color = discord.Color.yellow()
-                    # zipファイル名にタイムスタンプを付与
-                    zip_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                    zip_base = os.path.join(temp_path, f'uploads_{zip_timestamp}')
-                    await asyncio.to_thread(shutil.make_archive, zip_base, 'zip', uploads_dir)
-                    self.status_content = '[uploading] 1/1'
-                    self.embed_color = discord.Color.teal()
-                    uploadzip_dir = f'{zip_base}.zip'
-                    await self.upload_file(uploadzip_dir, self.input_url_list)
-
-            self.delete_folder(temp_path)
-            self.status_content = '[finished]'
-            self.embed_color = discord.Color.brand_green()
-
-            await asyncio.sleep(1)
-            print('finished')
-            await self.bot.change_presence(activity=discord.Game(name=''))
+            await self.process_job()
         except Exception as e:
             print(f'main()でエラーが発生しました: {e}')
             traceback.print_exc()
@@ -546,94 +1579,96 @@ class OptionModal(discord.ui.Modal):
         self.edit_message.start()
 
         try:
-            if 'local' in self.options:
-                temp_path = 'H:/'
-            else:
-                temp_path = os.path.join(tempfile.gettempdir(), "YTD_temp")
-                self.delete_folder(temp_path)
+            await self.process_job()
+        except (asyncio.CancelledError, JobCancelled):
+            if not self.cancelled.is_set():
+                # botの終了で止められた。キャンセル扱いにせず、再起動後に再開させる
+                raise
+            print(f'ジョブ {self.job_id} はキャンセルされました')
+            self.status_content = '[cancelled]'
+            self.embed_color = discord.Color.dark_red()
+            await self.edit_message()
+        except Exception as e:
+            print(f'main_without_interaction()でエラーが発生しました: {e}')
+            traceback.print_exc()
+            self.status_content = '[error]'
+            self.embed_color = discord.Color.red()
+        finally:
+            # 確実にedit_messageタスクを停止
+            self.run = False
+            if self.edit_message.is_running():
+                self.edit_message.stop()
 
-                uploads_dir = os.path.join(temp_path, 'uploads')
-                os.makedirs(uploads_dir)
+    async def process_job(self) -> None:
+        """URLの解決からダウンロード・アップロードまでを実行する"""
+        if 'local' in self.options:
+            self.workspace = workspace_manager.create(self.job_id, path='H:/', keep=True)
+        else:
+            self.workspace = workspace_manager.create(self.job_id)
+        uploads_dir = self.workspace.uploads_dir
 
+        try:
             self.input_url_list = self.url_input.value.split()
-            url_list, self.num = self.get_urllist(self.input_url_list)
+            url_list, self.num = await self.get_urllist(self.input_url_list)
 
             if self.num > self.max_downloads:
-                embed = discord.Embed(
-                    description = f'一度にダウンロードできる最大ファイル数は {self.max_downloads} です。',
-                )
-                await self.channel.send(embed=embed)
+                await self.send_limit_exceeded()
                 return
 
             if len(url_list) == 0:
                 # 無効なURLエラー
                 return
-            print(url_list)
+            logging.info(f'YTD: 入力 {len(self.input_url_list)}件, 確定済みアイテム {self.num}件, 展開待ちプレイリスト {sum(1 for item in url_list if type(item) is FlatPlaylist)}件')
 
+            # 再起動前に完了していたアイテムは飛ばす
+            done_items = job_store.done_items(self.job_id)
+            self.upload_order = []
+            self.num = 0
+            self.done = 0
             self.cnt = 1
-            for item in url_list:
-                    self.status_content = '[downloading]'
-                    self.embed_color = discord.Color.brand_red()
-                    if type(item) is tuple:
-                        downloads_dir = os.path.join(temp_path, item[1])
-                        for url in item[0]:
-                            try:
-                                await asyncio.to_thread(self.download, downloads_dir, url, self.extension, self.resolution, self.thumbnail, self.metadata,)
-                            except Exception:
-                                traceback.print_exc()
-                            self.cnt += 1
-                        self.cnt -= 1
-                        self.status_content = '[making zip]'
-                        self.embed_color = discord.Color.yellow()
+            self.status_content = '[downloading]'
+            self.embed_color = discord.Color.brand_red()
+            job_slots = asyncio.Semaphore(JOB_DOWNLOAD_CONCURRENCY)
+            # zipfile=Falseの場合はダウンロード中とアップロード待ちのアイテム数を制限する
+            buffer_slots = asyncio.Semaphore(JOB_DOWNLOAD_CONCURRENCY + UPLOAD_BUFFER_SIZE) if self.zipfile == False else None
+            # 展開済みで未完了のアイテム (index, url, folder, task)
+            window: collections.deque = collections.deque()
+            entries = self.iter_entries(url_list)
 
-                        if self.zipfile == False:
-                            self.status_content = f'[uploading] {self.cnt}/{self.num} : {item[1]}'
-                            self.embed_color = discord.Color.teal()
-                            await self.upload_file(downloads_dir, item)
-                            self.delete_folder(downloads_dir)
-                        else:
-                            shutil.move(downloads_dir, uploads_dir)
-                            # move後はdownloads_dirは存在しないので削除不要
-                        self.cnt += 1
-
-                    elif type(item) is str:
-                        downloads_dir = os.path.join(temp_path, 'downloads')
-                        logging.info(f'YTD: ダウンロード開始 - {item}')
-                        try:
-                            await asyncio.to_thread(self.download, downloads_dir, item, self.extension, self.resolution, self.thumbnail, self.metadata)
-                            logging.info(f'YTD: ダウンロード完了 - {item}')
-                        except Exception as e:
-                            logging.error(f'YTD: ダウンロードエラー - {e}')
-                            traceback.print_exc()
-                        
-                        # ダウンロードディレクトリが存在し、ファイルがあるか確認
-                        if not os.path.exists(downloads_dir) or len(os.listdir(downloads_dir)) == 0:
-                            logging.warning(f'YTD: ダウンロード失敗またはファイルなし - {item}')
-                            self.cnt += 1
-                            continue
-                        
-                        logging.info(f'YTD: downloads_dir内容 - {os.listdir(downloads_dir)}')
-                        download_path = os.path.join(downloads_dir, os.listdir(downloads_dir)[0])
-
-                        if self.zipfile == False:
-                            self.status_content = f'[uploading] {self.cnt}/{self.num} : {os.listdir(downloads_dir)[0]}'
-                            self.embed_color = discord.Color.teal()
-                            logging.info(f'YTD: アップロード開始 - {download_path}')
-                            await self.upload_file(download_path, item)
-                            logging.info(f'YTD: アップロード完了')
-                        else:
-                            if 'local' not in self.options:
-                                logging.info(f'YTD: ファイル移動 - {download_path} -> {uploads_dir}')
-                                shutil.move(download_path, uploads_dir)
-
-
-                        self.cnt += 1
-                        if 'local' not in self.options:
-                            self.delete_folder(downloads_dir)
+            try:
+                # プレイリストは取得できた分からダウンロードを始める
+                # ダウンロードは並列、アップロード・移動は入力順に行う
+                async for url, folder in entries:
+                    if self.num >= self.max_downloads:
+                        # 上限より先は展開・取得せず、ここまでの分をアップロードして終える
+                        await self.send_limit_exceeded(truncated=True)
+                        break
+                    index = self.num
+                    self.num += 1
+
+                    if url in done_items:
+                        task = None
+                        self.done += 1
+                        self.cnt = min(self.done + 1, self.num)
+                    else:
+                        task = asyncio.create_task(self.download_item(index, url, job_slots, buffer_slots))
+                    window.append((index, url, folder, task))
+
+                    while len(window) > STREAM_WINDOW_SIZE:
+                        await self.finish_next(window, done_items, buffer_slots)
+
+                while window:
+                    await self.finish_next(window, done_items, buffer_slots)
+            finally:
+                # 途中で抜けた場合もプレイリストの取得スレッドを止める
+                await entries.aclose()
+                for index, url, folder, task in window:
+                    if task is not None:
+                        task.cancel()
 
             logging.info(f'YTD: ダウンロードループ終了, zipfile={self.zipfile}')
             # ダウンロードされたファイル数を確認し、1個のファイルなら圧縮せず送信、複数またはフォルダならzip化
-            if self.zipfile == True:
+            if self.zipfile == True and 'local' not in self.options:
                 logging.info(f'YTD: uploads_dir={uploads_dir}, exists={os.path.exists(uploads_dir)}')
                 if os.path.exists(uploads_dir):
                     logging.info(f'YTD: uploads_dir内容={os.listdir(uploads_dir)}')
@@ -647,8 +1682,8 @@ class OptionModal(discord.ui.Modal):
                         self.status_content = '[making zip]'
                         self.embed_color = discord.Color.yellow()
                         zip_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        zip_base = os.path.join(temp_path, f'uploads_{zip_timestamp}')
-                        await asyncio.to_thread(shutil.make_archive, zip_base, 'zip', file_path)
+                        zip_base = os.path.join(self.workspace.path, f'uploads_{zip_timestamp}')
+                        await asyncio.to_thread(self.make_zip, f'{zip_base}.zip', file_path)
                         self.status_content = '[uploading] 1/1'
                         self.embed_color = discord.Color.teal()
                         uploadzip_dir = f'{zip_base}.zip'
@@ -664,30 +1699,255 @@ class OptionModal(discord.ui.Modal):
                     self.embed_color = discord.Color.yellow()
                     # zipファイル名にタイムスタンプを付与
                     zip_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                    zip_base = os.path.join(temp_path, f'uploads_{zip_timestamp}')
-                    await asyncio.to_thread(shutil.make_archive, zip_base, 'zip', uploads_dir)
+                    zip_base = os.path.join(self.workspace.path, f'uploads_{zip_timestamp}')
+                    await asyncio.to_thread(self.make_zip, f'{zip_base}.zip', uploads_dir)
                     self.status_content = '[uploading] 1/1'
                     self.embed_color = discord.Color.teal()
                     uploadzip_dir = f'{zip_base}.zip'
                     await self.upload_file(uploadzip_dir, self.input_url_list)
 
-            self.delete_folder(temp_path)
             self.status_content = '[finished]'
             self.embed_color = discord.Color.brand_green()
 
             await asyncio.sleep(1)
             print('finished')
             await self.bot.change_presence(activity=discord.Game(name=''))
-        except Exception as e:
-            print(f'main_without_interaction()でエラーが発生しました: {e}')
-            traceback.print_exc()
-            self.status_content = '[error]'
-            self.embed_color = discord.Color.red()
+        except asyncio.CancelledError:
+            if not self.cancelled.is_set():
+                # botの終了で止められた場合は、再起動後に続きから行えるよう作業ディレクトリを残す
+                self.workspace.keep = True
+            raise
         finally:
-            # 確実にedit_messageタスクを停止
-            self.run = False
-            if self.edit_message.is_running():
-                self.edit_message.stop()
+            # 作業ディレクトリはバックグラウンドで削除
+            workspace_manager.release(self.workspace, self.delete_folder)
+
+    async def send_limit_exceeded(self, truncated: bool = False) -> None:
+        description = f'一度にダウンロードできる最大ファイル数は {self.max_downloads} です。'
+        if truncated:
+            description += f'\n先頭の {self.max_downloads} 件のみダウンロードし、残りは取得しません。'
+        embed = discord.Embed(
+            description = description,
+        )
+        await self.channel.send(embed=embed)
+
+    async def iter_entries(self, url_list: list):
+        """url_listを (URL, フォルダ名) の並びとして入力順に返す。プレイリストは取得しながら返す"""
+        for item in url_list:
+            if type(item) is str:
+                yield item, None
+            elif type(item) is tuple:
+                for url in item[0]:
+                    yield url, item[1]
+            elif type(item) is FlatPlaylist:
+                # 途中で閉じられたときに取得スレッドを止めるため、内側も明示的に閉じる
+                urls = self.stream_flat(item)
+                try:
+                    async for url in urls:
+                        # 他の入力と重複する項目は飛ばす
+                        if self.first_seen(url):
+                            yield url, item.name
+                finally:
+                    await urls.aclose()
+
+    async def stream_flat(self, playlist: FlatPlaylist):
+        """プレイリストの項目をページ取得に合わせて順に返す"""
+        cached, fresh = resolve_cache.get(f'flat_{playlist.state}', playlist.url)
+        if cached is not None and (fresh or playlist.state == 'channel'):
+            # キャッシュ済み、またはチャンネルの差分更新で済む場合
+            urls, name = await asyncio.to_thread(self.extract_url, playlist.url, playlist.state)
+            playlist.set_name(name)
+            for url in urls:
+                yield url
+            return
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        # 取得スレッドが先行しすぎないように未消費の件数を制限する
+        room = threading.Semaphore(RESOLVE_PAGE_SIZE)
+        stop = threading.Event()
+        producer = asyncio.create_task(asyncio.to_thread(self.fetch_flat_stream, playlist, queue, loop, room, stop))
+        urls = []
+        info = {}
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                room.release()
+                url, metadata = item
+                if metadata:
+                    self.item_info.setdefault(url, metadata)
+                if urls is not None:
+                    if len(urls) < RESOLVE_CACHE_MAX_URLS:
+                        urls.append(url)
+                        if metadata:
+                            info[url] = metadata
+                    else:
+                        # 大きすぎるものはキャッシュせず、集めた分も手放す
+                        urls = info = None
+                yield url
+            try:
+                await producer
+            except JobCancelled:
+                raise
+            except Exception as e:
+                # 取得できた分だけで続行し、途中までの結果はキャッシュしない
+                print(f'url loading failed: {e}')
+                return
+            if urls is not None:
+                resolve_cache.put(f'flat_{playlist.state}', playlist.url, {'urls': urls, 'name': playlist.name, 'info': info})
+        finally:
+            stop.set()
+            room.release()
+            if not producer.done():
+                # 途中で閉じられた場合。スレッドはstopを見て取得中のページの後で止まる
+                producer.cancel()
+            producer.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def fetch_flat_stream(self, playlist: FlatPlaylist, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, room: threading.Semaphore, stop: threading.Event) -> None:
+        """プレイリストを遅延取得し、項目をqueueへ流す（別スレッドで実行）"""
+        ydl_opts = {
+            'quiet': True,
+            'extract_flat': True,
+            'force_generic_extractor': True,
+            'lazy_playlist': True,
+        }
+        try:
+            with ydl_pool.checkout(ydl_opts) as ydl:
+                info_dict = ydl.extract_info(playlist.url, download=False, process=False)
+                # 別URLへの転送なら辿る
+                while info_dict.get('_type') in ('url', 'url_transparent'):
+                    info_dict = ydl.extract_info(info_dict['url'], download=False, process=False)
+
+                if playlist.state == 'playlist':
+                    playlist.set_name(info_dict.get('title'))
+                elif playlist.state == 'channel':
+                    playlist.set_name(info_dict.get('channel'))
+
+                for entry in info_dict.get('entries') or []:
+                    room.acquire()
+                    if stop.is_set() or self.cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, (entry['url'], entry_metadata(entry)))
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def finish_next(self, window: collections.deque, done_items: dict, buffer_slots: Optional[asyncio.Semaphore]) -> None:
+        """windowの先頭のアイテムの完了を待って後処理する"""
+        index, url, folder, task = window.popleft()
+        if task is None:
+            # 再起動前に完了済み
+            self.upload_order.extend(os.path.join(self.workspace.path, path) for path in done_items[url])
+            return
+        downloads_dir = await task
+        try:
+            await self.finish_item(index, url, folder, downloads_dir)
+        finally:
+            if buffer_slots is not None:
+                buffer_slots.release()
+
+    async def download_item(self, index: int, url: str, job_slots: asyncio.Semaphore, buffer_slots: Optional[asyncio.Semaphore] = None) -> str:
+        """1アイテムを専用ディレクトリにダウンロードし、そのパスを返す"""
+        downloads_dir = self.workspace.item_dir(index)
+        if buffer_slots is not None:
+            # 解放はアップロード完了後にfinish_item側で行う
+            await buffer_slots.acquire()
+        async with job_slots, download_limiter.slot(url):
+            # 前回の途中で落ちたアイテムの残骸があれば消してからやり直す
+            if os.path.isdir(downloads_dir):
+                await asyncio.to_thread(self.delete_folder, downloads_dir)
+            await workspace_manager.wait_for_quota(self.workspace)
+            logging.info(f'YTD: ダウンロード開始 - {url}')
+            stage = None
+            download_future = asyncio.ensure_future(asyncio.to_thread(self.download, downloads_dir, url, self.extension, self.resolution, self.thumbnail, self.metadata))
+            try:
+                stage = await asyncio.shield(download_future)
+                logging.info(f'YTD: ダウンロード完了 - {url}')
+            except asyncio.CancelledError:
+                # スレッドは止められないので、終わったときに受け取り手のいない状態のロックを解放する
+                download_future.add_done_callback(self.release_orphaned_stage)
+                raise
+            except JobCancelled:
+                raise
+            except Exception as e:
+                logging.error(f'YTD: ダウンロードエラー - {e}')
+                traceback.print_exc()
+
+        # 後処理はダウンロード枠を空けてから行い、その間に次のアイテムを取得する
+        if stage is not None:
+            ok = False
+            try:
+                await self.postprocess(stage)
+                ok = True
+            except JobCancelled:
+                raise
+            except Exception as e:
+                logging.error(f'YTD: 後処理エラー - {e}')
+                traceback.print_exc()
+            finally:
+                # ロックを解放するので、ここで取り消されても最後まで行う
+                await asyncio.shield(asyncio.to_thread(self.finish_download, stage, ok))
+        self.done += 1
+        self.cnt = min(self.done + 1, self.num)
+        return downloads_dir
+
+    async def finish_item(self, index: int, url: str, folder: Optional[str], downloads_dir: str) -> None:
+        """ダウンロード済みのアイテムをアップロード、またはzip用フォルダへ移動する"""
+        uploads_dir = self.workspace.uploads_dir
+
+        # ダウンロードディレクトリが存在し、ファイルがあるか確認
+        if not os.path.exists(downloads_dir) or len(os.listdir(downloads_dir)) == 0:
+            logging.warning(f'YTD: ダウンロード失敗またはファイルなし - {url}')
+            return
+
+        logging.info(f'YTD: downloads_dir内容 - {os.listdir(downloads_dir)}')
+        moved = []
+        for name in sorted(os.listdir(downloads_dir)):
+            download_path = os.path.join(downloads_dir, name)
+
+            if self.zipfile == False:
+                self.status_content = f'[uploading] {index+1}/{self.num} : {name}'
+                self.embed_color = discord.Color.teal()
+                logging.info(f'YTD: アップロード開始 - {download_path}')
+                await self.upload_file(download_path, url)
+                logging.info('YTD: アップロード完了')
+            elif 'local' not in self.options:
+                target_dir = uploads_dir if folder is None else os.path.join(uploads_dir, folder)
+                os.makedirs(target_dir, exist_ok=True)
+                logging.info(f'YTD: ファイル移動 - {download_path} -> {target_dir}')
+                moved.append(shutil.move(download_path, target_dir))
+
+        self.upload_order.extend(moved)
+        job_store.mark_item_done(self.job_id, url, [os.path.relpath(path, self.workspace.path) for path in moved])
+
+        if 'local' not in self.options:
+            self.cleanup(downloads_dir)
+
+    def make_zip(self, zip_path: str, root_dir: str) -> str:
+        """入力順を保ったままzipを作成する"""
+        with ZipFile(zip_path, 'w', ZIP_DEFLATED) as zf:
+            for path in self.upload_order:
+                if os.path.commonpath([path, root_dir]) == root_dir:
+                    zf.write(path, os.path.relpath(path, root_dir))
+        return zip_path
+
+    def cancel(self) -> None:
+        """実行中のダウンロード・アップロードを中断する"""
+        self.cancelled.set()
+        for process in list(self.processes):
+            if process.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+        if self.job_task is not None:
+            self.job_task.cancel()
+
+    def check_cancelled(self) -> None:
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def cleanup(self, path: str) -> None:
+        """イベントループを止めずにフォルダを削除する"""
+        workspace_manager.cleanup(path, self.delete_folder)
 
     def delete_folder(self, folder: str) -> None:
         if os.path.isdir(folder):
@@ -793,12 +2053,14 @@ class OptionModal(discord.ui.Modal):
         except Exception as e:
             print(f'edit_messageでエラー: {e}')
 
-    async def progress_send(self, interaction: discord.Interaction) -> None:
-        embed = discord.Embed(
-            description = 'This string has no meaning :-)'
-        )
-        await interaction.response.send_message(embed=embed, delete_after=0.1, ephemeral=True)
+    def status_line(self) -> str:
+        """/progress用の1行サマリー"""
+        if not getattr(self, 'run', False):
+            return f'`{self.job_id}` [initializing]'
+        t = int(time.time() - self.time)
+        return f'`{self.job_id}` {self.author_name} {self.status_content} {self.progress_content} ({str(t//3600).zfill(2)}:{str((t%3600)//60).zfill(2)}:{str(t%3600%60).zfill(2)})'
 
+    async def progress_send(self, channel: discord.abc.Messageable) -> None:
         if self.run:
             t = int(time.time() - self.time)
             embed = discord.Embed(
@@ -810,7 +2072,7 @@ class OptionModal(discord.ui.Modal):
         else:
             embed = discord.Embed(description='There are no processes currently running.')
 
-        self.msg = await interaction.channel.send(embed=embed,file=None)
+        self.msg = await channel.send(embed=embed,file=None)
 
     async def upload_file(self, path: str, message: str) -> None:
         print('uploading now')
@@ -840,24 +2102,61 @@ class OptionModal(discord.ui.Modal):
         os.remove(path)
 
     async def upload_to_gigafile(self, path: str) -> str:
-        gigafile = Giga(self, path)
+        return await gigafile_client.upload(self, path)
+
+    def extract_url(self, url: str, state='') -> tuple[list,str]:
+        cached, fresh = resolve_cache.get(f'flat_{state}', url)
+        if cached is not None:
+            # キャッシュ作成前の形式にはinfoがない
+            info = cached.get('info', {})
+            for entry_url, metadata in info.items():
+                self.item_info.setdefault(entry_url, metadata)
+            if fresh:
+                return cached['urls'], cached['name']
+
+        url_temp_list = None
+        if cached is not None and state == 'channel':
+            # チャンネルは新しい順なので先頭だけ取得して差分を足す
+            url_temp_list, name, new_info = self.fetch_flat(url, state, playlistend=RESOLVE_REFRESH_PAGE)
+            known = set(cached['urls'])
+            new_urls = []
+            for entry_url in url_temp_list:
+                if entry_url in known:
+                    url_temp_list = new_urls + cached['urls']
+                    info = {**info, **new_info}
+                    break
+                new_urls.append(entry_url)
+            else:
+                # 先頭ページがすべて新規なら全件取り直す
+                url_temp_list = None
 
-        await asyncio.to_thread(gigafile.upload)
+        if url_temp_list is None:
+            url_temp_list, name, info = self.fetch_flat(url, state)
 
-        return gigafile.get_download_page()
+        for entry_url, metadata in info.items():
+            self.item_info[entry_url] = metadata
+        resolve_cache.put(f'flat_{state}', url, {'urls': url_temp_list, 'name': name, 'info': info})
+        return url_temp_list, name
 
-    def extract_url(self, url: str, state='') -> tuple[list,str]:
+    def fetch_flat(self, url: str, state: str, playlistend: Optional[int] = None) -> tuple[list,str,dict]:
         url_temp_list = []
+        info = {}
 
         ydl_opts = {
             'quiet': True,
             'extract_flat': True,
             'force_generic_extractor': True,
         }
+        if playlistend is not None:
+            ydl_opts['playlistend'] = playlistend
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.checkout(ydl_opts) as ydl:
             info_dict = ydl.extract_info(url, download=False)
             video_urls = [entry['url'] for entry in info_dict['entries']]
+            for entry in info_dict['entries']:
+                metadata = entry_metadata(entry)
+                if metadata:
+                    info[entry['url']] = metadata
 
             if state == 'playlist':
                 name:str = info_dict.get('title')
@@ -867,107 +2166,270 @@ class OptionModal(discord.ui.Modal):
         for url in video_urls:
             url_temp_list.append(url)
 
-        return url_temp_list, name
+        return url_temp_list, name, info
+
+    def probe_soundcloud(self, url: str) -> Tuple[str, Optional[str], Optional[dict]]:
+        """短縮URLを展開し、(URL, _type, 抽出結果) を返す
+
+        抽出結果は単体トラックをそのままダウンロードに使うためのもので、キャッシュから返した場合はNone
+        """
+        if 'on.soundcloud.com' in url:
+            cached, fresh = resolve_cache.get('redirect', url)
+            if fresh:
+                url = cached
+            else:
+                res = requests.get(url)
+                resolve_cache.put('redirect', url, res.url)
+                url = res.url
+
+        cached, fresh = resolve_cache.get('probe', url)
+        if fresh:
+            return url, cached, None
+
+        ydl_opts = {
+            'quiet': True,
+            'extract_flat': True,
+            'force_generic_extractor': True,
+        }
 
-    def get_urllist(self, input_url_list: list[str]) -> Tuple[list[str|tuple], int]:
+        with ydl_pool.checkout(ydl_opts) as ydl:
+            # フォーマット選択はダウンロード時に行うので抽出だけにする
+            info_dict = ydl.extract_info(url, download=False, process=False)
+            while info_dict.get('_type') in ('url', 'url_transparent'):
+                info_dict = ydl.extract_info(info_dict['url'], download=False, process=False)
+
+        # 署名付きのフォーマットURLは期限切れになるので、キャッシュするのは_typeだけ
+        resolve_cache.put('probe', url, info_dict.get('_type'))
+        return url, info_dict.get('_type'), info_dict
+
+    def get_mylist(self, url: str) -> list[tuple[list,str]]:
+        cached, fresh = resolve_cache.get('mylist', url)
+        if fresh:
+            return [(urls, name) for urls, name in cached]
+
+        mylists = []
+        client = NicoNico()
+        for mylist in client.video.get_mylist(url):
+            mylists.append(([line.video.url for line in mylist.items], mylist.name))
+        resolve_cache.put('mylist', url, mylists)
+        return mylists
+
+    async def get_urllist(self, input_url_list: list[str]) -> Tuple[list[str|tuple|FlatPlaylist], int]:
+        """入力URLをスレッドで並列に解決する。結果は入力順に並べる"""
+        self.resolved = 0
+        # URLごとに解決時に分かったメタデータ。抽出済みの場合は抽出結果そのもの
+        self.item_info: dict[str, dict] = {}
+        slots = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+        results = await asyncio.gather(*(self.resolve_input_async(url, len(input_url_list), slots) for url in input_url_list))
+
+        # 入力全体で同じ動画・プレイリストは1回だけにする
+        self.seen_keys = set()
         url_list = []
-        cnt = 0
+        for items in results:
+            for item in items:
+                if type(item) is str:
+                    if not self.first_seen(item):
+                        continue
+                elif type(item) is tuple:
+                    item = ([url for url in item[0] if self.first_seen(url)], item[1])
+                elif type(item) is FlatPlaylist:
+                    if not self.first_seen(item.url):
+                        continue
+                url_list.append(item)
+        # FlatPlaylistの件数はダウンロードしながら確定する
+        cnt = sum(len(item[0]) if type(item) is tuple else 1 if type(item) is str else 0 for item in url_list)
+        return url_list, cnt
 
-        for url in input_url_list:
-            self.status_content = f'[loading url] {cnt+1}/{len(url_list)}'
-            url_temp_list = []
+    def first_seen(self, url: str) -> bool:
+        """このジョブで初めて出てきたURLならTrue"""
+        canonical = canonicalize_url(url)
+        key = canonical[1] if canonical else url
+        if key in self.seen_keys:
+            return False
+        self.seen_keys.add(key)
+        return True
+
+    async def resolve_input_async(self, url: str, total: int, slots: asyncio.Semaphore) -> list[str|tuple|FlatPlaylist]:
+        async with slots:
             try:
-                if re.fullmatch(r'sm\d+', url):
-                    url = f'https://www.nicovideo.jp/watch/{url}'
-                elif (
-                    not url.startswith('https://')
-                    and len(url) == 11
-                    and re.fullmatch(r'[A-Za-z0-9_-]{11}', url)
-                ):
-                    url = f'https://www.youtube.com/watch?v={url}'
-                if 'https://' in url:
-                    if 'youtube' in url:
-                        if '@' in url:
-                            url_list.append(self.extract_url(url, state='channel'))
-                            cnt += len(url_list[-1][0])
-                        else:
-                            if 'm.' in url:
-                                url = url.replace('m.','www.')
-                            if 'shorts' in url:
-                                url = 'https://www.youtube.com/watch?v='+url[31:]
-                            if '&t=' in url:
-                                url = url[:43]
-                            if '&list=' in url:
-                                url = url[:43]
-                            if '&pp=' in url:
-                                url = url[:43]
-                            if len(url) == 43:
-                                url_list.append(url)
-                                cnt += 1
-                            elif 'playlist' in url:
-                                url_list.append(self.extract_url(url, state='playlist'))
-                                cnt += len(url_list[-1][0])
-
-                    elif 'youtu.be' in url:
-                        url = url[:28]
-                        url = 'https://www.youtube.com/watch?v=' + url[17:]
-                        url_list.append(url)
-                        cnt += 1
-
-                    elif 'soundcloud.com' in url:
-                        if 'on.soundcloud.com' in url:
-                            res = requests.get(url)
-                            url = res.url
-
-                        ydl_opts = {
-                            'quiet': True,
-                            'extract_flat': True,
-                            'force_generic_extractor': True,
-                        }
-
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            info_dict = ydl.extract_info(url, download=False)
-
-                        if info_dict.get('_type') == 'playlist':
-                            url += '/tracks'
-                            url_temp_list, name = self.extract_url(url, state='playlist')
-
-                            if name[-8:] == '(Tracks)':
-                                name = name[:-9]
-
-                            url_list.append((url_temp_list, name))
-                            cnt += len(url_list[-1][0])
-
-                        elif info_dict.get('_type') == None:
-                            url_list.append(url)
-                            cnt += 1
-
-                        else:
-                            print(info_dict.get('_type'))
-                            print('exceptional error')
-
-                    elif 'https://www.nicovideo.jp/' in url and 'mylist' in url:
-                        client = NicoNico()
-                        for mylist in client.video.get_mylist(url):
-                            for line in mylist.items:
-                                url_temp_list.append(line.video.url)
-                            url_list.append((url_temp_list, mylist.name))
-                            cnt += len(url_list[-1][0])
-
-                    else:
-                        url_list.append(url)
-                        cnt += 1
-            except:
+                items = await asyncio.to_thread(self.resolve_input, url)
+            except Exception:
                 print('url loading failed')
+                items = []
+        self.resolved += 1
+        self.status_content = f'[loading url] {self.resolved}/{total}'
+        return items
+
+    def resolve_input(self, url: str) -> list[str|tuple|FlatPlaylist]:
+        """入力1行分をダウンロード対象のURL、または(URLのリスト, フォルダ名)に展開する"""
+        canonical = canonicalize_url(url)
+        if canonical is None:
+            return []
+        kind, key, url = canonical
+
+        if kind == 'youtube_channel':
+            return [FlatPlaylist(url, 'channel')]
+
+        elif kind == 'youtube_playlist':
+            return [FlatPlaylist(url, 'playlist')]
+
+        elif kind in ('soundcloud', 'soundcloud_short'):
+            url, info_type, info_dict = self.probe_soundcloud(url)
+
+            if info_type == 'playlist':
+                return [FlatPlaylist(url.rstrip('/') + '/tracks', 'playlist', strip_suffix='(Tracks)')]
+            elif info_type == None:
+                track_url = canonicalize_url(url)[2]
+                if info_dict is not None:
+                    self.item_info[track_url] = info_dict
+                return [track_url]
+            else:
+                print(info_type)
+                print('exceptional error')
+                return []
 
-        return url_list, cnt
+        elif kind == 'nicovideo_mylist':
+            return self.get_mylist(url)
 
-    def download(self, path: str , url: str, extension: str, resolution: str, thumbnail: str, metadata: str) -> None:
-        self.status_content = f'[downloading] {self.cnt}/{self.num}'
+        return [url]
+
+    def download(self, path: str , url: str, extension: str, resolution: str, thumbnail: str, metadata: str) -> Optional[dict]:
+        """ダウンロードまでを行い、postprocessとfinish_downloadに渡す状態を返す。キャッシュから渡した場合はNone"""
+        info = self.item_info.pop(url, {})
+        if info.get('title'):
+            self.status_content = f'[downloading] {self.cnt}/{self.num} : {info["title"]}'
+        else:
+            self.status_content = f'[downloading] {self.cnt}/{self.num}'
 
         # ダウンロード先ディレクトリが存在しない場合は作成（Linux対応）
         os.makedirs(path, exist_ok=True)
 
+        stage = {'path': path, 'work_dir': path, 'lock': None, 'cache_key': None, 'result': None, 'post': [], 'outputs': []}
+        key = self.download_key(url)
+        if key is not None and 'gigafile.nu' not in url:
+            # 後処理が終わるまで同じアイテムを他のジョブが触らないようにする。解放はfinish_downloadで行う
+            stage['lock'] = workspace_manager.partial_lock(key)
+            stage['lock'].acquire()
+            # 同じ設定で取得済みのメディアならダウンロード・変換せずにキャッシュから渡す
+            # 他のジョブが同じアイテムを取得し終えるのを待った場合もここで渡せる
+            stage['cache_key'] = self.media_cache_key(url)
+            if stage['cache_key'] is not None and media_cache.get(stage['cache_key'], path):
+                stage['lock'].release()
+                logging.info(f'YTD: キャッシュから取得 - {url}')
+                return None
+
+            # 途中で落ちても.partやaria2の制御ファイルが残り、次回は続きから取得する
+            stage['work_dir'] = workspace_manager.partial_dir(key)
+            os.makedirs(stage['work_dir'], exist_ok=True)
+
+        try:
+            stage['result'], stage['post'], stage['outputs'] = self.download_media(stage['work_dir'], url, info, extension, resolution, thumbnail, metadata)
+        except BaseException:
+            if stage['lock'] is not None:
+                stage['lock'].release()
+            raise
+        return stage
+
+    async def postprocess(self, stage: dict) -> None:
+        """残っている後処理を動画ごとに行う。ffmpegはprocessesに登録し、/stopでkillできるようにする"""
+        for options, transcode_args, info in stage['post']:
+            self.check_cancelled()
+            await self.postprocess_one(stage, options, transcode_args, info)
+
+    async def postprocess_one(self, stage: dict, options: dict, transcode_args: Optional[list[str]], info: dict) -> None:
+        async with postprocess_slots:
+            self.status_content = f'[processing] {self.cnt}/{self.num} : {os.path.basename(info["filepath"])}'
+            command = one_pass_command(options, transcode_args, info)
+            if command is None:
+                return
+            args, out_path, thumbnail = command
+            temp = yt_dlp.utils.prepend_extension(out_path, 'temp')
+            if await self.run_ffmpeg([*args, temp]) == 0:
+                os.replace(temp, out_path)
+                if out_path != info['filepath']:
+                    os.remove(info['filepath'])
+                if thumbnail:
+                    os.remove(thumbnail)
+                self.replace_output(stage, info['filepath'], out_path)
+                return
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp)
+            print(f'single-pass postprocess failed: {info["filepath"]}')
+
+            # 1回でまとめて処理できなかった場合は再エンコードとyt-dlpの後処理を順に行う
+            filepath = info['filepath']
+            if transcode_args:
+                temp = yt_dlp.utils.prepend_extension(filepath, 'temp')
+                args = ['ffmpeg', '-y', '-loglevel', 'error', '-i', filepath, '-map', '0', '-c', 'copy', *transcode_args, temp]
+                code = await self.run_ffmpeg(args)
+                if code != 0:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(temp)
+                    raise subprocess.CalledProcessError(code, args)
+                os.replace(temp, filepath)
+            final = await asyncio.to_thread(run_ydl_postprocessors, options, info)
+            self.replace_output(stage, filepath, final['filepath'])
+        self.check_cancelled()
+
+    def replace_output(self, stage: dict, old: str, new: str) -> None:
+        """後処理で出力先が変わったファイルを差し替える"""
+        stage['outputs'] = [new if output == old else output for output in stage['outputs']]
+
+    async def run_ffmpeg(self, args: list[str]) -> int:
+        """ffmpegを実行して終了コードを返す"""
+        self.check_cancelled()
+        process = await asyncio.create_subprocess_exec(*args)
+        self.processes.add(process)
+        try:
+            return await process.wait()
+        finally:
+            if process.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+            self.processes.discard(process)
+            self.check_cancelled()
+
+    def release_orphaned_stage(self, future: asyncio.Future) -> None:
+        """待っていたタスクが取り消されたダウンロードのロックを解放する"""
+        if future.cancelled() or future.exception() is not None:
+            # 例外のときはdownload内で解放済み
+            return
+        stage = future.result()
+        if stage is not None and stage['lock'] is not None:
+            stage['lock'].release()
+
+    def finish_download(self, stage: dict, ok: bool) -> None:
+        """後処理が済んだファイルをアイテムのディレクトリへ移し、キャッシュに登録する"""
+        try:
+            if not ok:
+                # 後処理に失敗したものは完成品として渡さない。次回はダウンロード済みのファイルから後処理をやり直す
+                return
+            if stage['work_dir'] != stage['path']:
+                # 前回の残りの.partやサムネイルは渡さず、今回の完成品だけを移す
+                for output in stage['outputs']:
+                    if os.path.isfile(output):
+                        shutil.move(output, stage['path'])
+                shutil.rmtree(stage['work_dir'], ignore_errors=True)
+
+            # 配信中・配信直後のものは内容が変わるのでキャッシュしない
+            result = stage['result']
+            if stage['cache_key'] is not None and result and result.get('_type', 'video') == 'video' \
+                    and result.get('live_status') not in ('is_live', 'is_upcoming', 'post_live'):
+                media_cache.put(stage['cache_key'], stage['path'])
+        finally:
+            if stage['lock'] is not None:
+                stage['lock'].release()
+
+    def download_media(self, path: str, url: str, info: dict, extension: str, resolution: str, thumbnail: str, metadata: str) -> Tuple[Optional[dict], list[tuple], list[str]]:
+        """pathにダウンロードし、(yt-dlpの結果, 残っている後処理, 出力したファイル) を返す
+
+        yt-dlpの後処理（音声抽出・メタデータ・サムネイル埋め込み・再エンコード）はここでは行わず、
+        postprocessに渡す (オプション, 再エンコードの引数, 情報) を動画ごとに返す。
+        """
+        result = None
+        post = []
+        outputs = []
         if 'gigafile.nu' in url:
             gigafile = Giga(self, url)
             dl_path = gigafile.download(path)
@@ -976,15 +2438,15 @@ class OptionModal(discord.ui.Modal):
                 shutil.unpack_archive(dl_path, path)
                 os.remove(dl_path)
                 time.sleep(20)
+            outputs = [os.path.join(path, name) for name in os.listdir(path)]
 
         elif not any(sub in url for sub in self.streamlink_sites):
             if extension == 'mp4':
                 options = {
                     'writethumbnail': thumbnail,
-                    'outtmpl': os.path.join(path, '%(title)s.%(ext)s'),
-                    'format': f'bv*[ext={extension}]+ba[ext=m4a]/b[ext={extension}]' if resolution == 'best' else f'wv*[ext={extension}]+wa[ext=m4a]/w[ext={extension}]' if resolution == 'worst' else f'bv[ext={extension}][height<={resolution}]+ba[ext=m4a]/best',
+                    'format': self.video_format(extension, resolution),
+                    'merge_output_format': extension,
                     'http_headers': {'Accept-Language': 'ja-JP'},
-                    'progress_hooks': [self.my_hook],
                     'live_from_start': True,
                     'postprocessors': [
                         {'key': 'FFmpegMetadata',
@@ -1011,10 +2473,9 @@ class OptionModal(discord.ui.Modal):
             else:
                 options = {
                     'writethumbnail': False if extension == 'wav' else thumbnail,
-                    'outtmpl': os.path.join(path, '%(title)s.%(ext)s'),
-                    'format': 'bestaudio/best',
+                    # 変換せずにコピーできる音声があればそれを選ぶ
+                    'format': f'bestaudio[acodec~="^({"|".join(AUDIO_CODEC_PREFIXES[extension])})"]/bestaudio/best' if AUDIO_CODEC_PREFIXES.get(extension) else 'bestaudio/best',
                     'http_headers': {'Accept-Language': 'ja-JP'},
-                    'progress_hooks': [self.my_hook],
                     'trim-filenames': 'LENGTH',
                     'live_from_start': True,
                     'postprocessors': [
@@ -1027,45 +2488,193 @@ class OptionModal(discord.ui.Modal):
                         ]
                 }
 
-            if any(sub in url for sub in self.aria2_sites):
-                options.update({
-                    'external_downloader': 'aria2c',
-                    'external_downloader_args': ['-x 16', '-k 1M', '-c', '-n'],
-                })
+            use_aria2 = any(sub in url for sub in self.aria2_sites) and aria2_daemon.available()
+            outtmpl = os.path.join(path, '%(title)s.%(ext)s')
+            # まずエンコード指定なしでフォーマットを選び、指定のコーデックが無い場合だけ再エンコードする
+            remux_options = {key: value for key, value in options.items() if key != 'postprocessor_args'}
 
-            with yt_dlp.YoutubeDL(options) as ydl:
-                ydl.download(url)
+            reused = 'formats' in info or 'url' in info
+            with ydl_pool.checkout(remux_options, outtmpl=outtmpl, progress_hook=self.my_hook, postprocessor_hook=self.pp_hook) as ydl:
+                if reused:
+                    # 解決時に抽出済みならページを取り直さずにフォーマットを選ぶ
+                    result = ydl.process_ie_result(info, download=False)
+                else:
+                    result = ydl.extract_info(url, download=False)
+
+            # 複数の動画に展開されるものも、抽出済みの各動画を同じようにダウンロードして後処理に回す
+            for video in self.video_entries(result):
+                transcode = self.needs_transcode(video, extension)
+                self.report_format(url, video, extension, transcode)
+
+                # ダウンロードと結合だけを行い、後処理に渡す情報を受け取る
+                captured = []
+                with ydl_pool.checkout({**remux_options, 'postprocessors': []}, outtmpl=outtmpl, progress_hook=self.my_hook, postprocessor_hook=self.pp_hook, info_hook=captured.append) as ydl:
+                    if use_aria2:
+                        self.prefetch_with_aria2(ydl, video)
+                    try:
+                        downloaded = ydl.process_ie_result(video, download=True)
+                    except yt_dlp.utils.DownloadError:
+                        if video is not result or not reused:
+                            raise
+                        self.check_cancelled()
+                        # フォーマットURLの期限切れなどは抽出からやり直す
+                        downloaded = ydl.extract_info(url, download=True)
+                if video is result:
+                    result = downloaded
+
+                for item in captured:
+                    # 修正用の後処理はダウンロード側で済んでいる
+                    pp_info = {key: value for key, value in item.items() if key != '__postprocessors'}
+                    post.append((remux_options, options.get('postprocessor_args') if transcode else None, pp_info))
+                    outputs.append(pp_info['filepath'])
 
         else:
-            title = self.get_video_title(url)
+            # プレイリストから来た項目はタイトルが分かっているので取得し直さない
+            title = info.get('title') or self.get_video_title(url)
             self.status_content = f'[downloading] {self.cnt}/{self.num} : {title}'
 
-            subprocess.run(
-                [
-                    'streamlink',
-                    url,
-                    '1080p' if resolution == 'best' else '360p' if resolution == 'worst' else resolution+'p',
-                    '-o',
-                    os.path.join(path, f'{title}.ts'),
-                ]
-            )
+            quality = '1080p' if resolution == 'best' else '360p' if resolution == 'worst' else resolution+'p'
+            # サブプロセスはイベントループ側で動かし、このスレッドは終わるまで待つ
+            out_path = os.path.join(path, f'{title}.mp4')
+            future = asyncio.run_coroutine_threadsafe(self.stream_remux(url, quality, out_path), self.bot.loop)
+            ok = future.result()
+            self.check_cancelled()
+            if not ok:
+                raise yt_dlp.utils.DownloadError(f'streamlink/ffmpeg failed: {url}')
+            outputs = [out_path]
 
-            subprocess.run(
-                [
-                    'ffmpeg',
-                    '-i',
-                    os.path.join(path, f'{title}.ts'),
-                    '-c',
-                    'copy',
-                    os.path.join(path, f'{title}.mp4')
-                ]
+        #self.progress_content = ''
+        return result, post, outputs
+
+    async def stream_remux(self, url: str, quality: str, out_path: str) -> bool:
+        """streamlinkの出力をパイプでffmpegに渡し、中間ファイルなしでfragmented MP4にする"""
+        read_fd, write_fd = os.pipe()
+        try:
+            streamlink = await asyncio.create_subprocess_exec(
+                'streamlink', '--stdout', url, quality,
+                stdout=write_fd, stderr=asyncio.subprocess.DEVNULL,
             )
+            ffmpeg = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-nostats', '-loglevel', 'error',
+                '-i', 'pipe:0',
+                '-c', 'copy',
+                '-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+                '-progress', 'pipe:1',
+                out_path,
+                stdin=read_fd, stdout=asyncio.subprocess.PIPE,
+            )
+        finally:
+            # パイプの端は子プロセスだけが持つようにする
+            os.close(read_fd)
+            os.close(write_fd)
+        self.processes.update((streamlink, ffmpeg))
 
-            os.remove(os.path.join(path, f'{title}.ts'))
+        try:
+            # -progressの出力は key=value の行で、progress= の行が1回分の区切り
+            progress = {}
+            async for line in ffmpeg.stdout:
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                progress[key] = value
+                if key == 'progress':
+                    size = int(progress['total_size']) if progress.get('total_size', '').isdigit() else 0
+                    self.progress_content = f'{progress.get("out_time", "").split(".")[0]} / {round(size/1048576, 2)} MiB at  {progress.get("speed", "").strip()}'
+            ffmpeg_code = await ffmpeg.wait()
+            streamlink_code = await streamlink.wait()
+        finally:
+            for process in (streamlink, ffmpeg):
+                if process.returncode is None:
+                    with contextlib.suppress(ProcessLookupError):
+                        process.kill()
+                    await process.wait()
+                self.processes.discard(process)
+
+        if ffmpeg_code != 0 or streamlink_code != 0:
+            print(f'streamlink/ffmpeg failed: {streamlink_code}/{ffmpeg_code}')
+            # 途中までのファイルは完了扱いにしない
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(out_path)
+            return False
+        return True
+
+    def video_format(self, extension: str, resolution: str) -> str:
+        """動画のフォーマット指定。コーデック指定があれば、そのコーデックの映像を優先して選ぶ"""
+        fallback = f'bv*[ext={extension}]+ba[ext=m4a]/b[ext={extension}]' if resolution == 'best' else f'wv*[ext={extension}]+wa[ext=m4a]/w[ext={extension}]' if resolution == 'worst' else f'bv[ext={extension}][height<={resolution}]+ba[ext=m4a]/best'
+        prefixes = VIDEO_CODEC_PREFIXES.get(self.codec)
+        if not prefixes:
+            return fallback
+        pick = 'w' if resolution == 'worst' else 'b'
+        height = '' if resolution in ('best', 'worst') else f'[height<={resolution}]'
+        return f'{pick}v*[vcodec~="^({"|".join(prefixes)})"]{height}+{pick}a[ext=m4a]/{fallback}'
+
+    def video_entries(self, result: dict) -> list[dict]:
+        """抽出結果に含まれる動画を、プレイリストを展開して返す"""
+        if result.get('_type', 'video') == 'video':
+            return [result]
+        return [video for entry in result.get('entries') or [] if entry for video in self.video_entries(entry)]
+
+    def needs_transcode(self, result: dict, extension: str) -> bool:
+        """選ばれたフォーマットが指定のコーデックと違い、再エンコードが必要か"""
+        if extension != 'mp4' or self.codec not in VIDEO_CODEC_PREFIXES:
+            return False
+        for f in result.get('requested_formats') or [result]:
+            vcodec = f.get('vcodec') or ''
+            if vcodec != 'none':
+                return not vcodec.startswith(VIDEO_CODEC_PREFIXES[self.codec])
+        return True
+
+    def report_format(self, url: str, result: dict, extension: str, transcode: bool) -> None:
+        formats = result.get('requested_formats') or [result]
+        codecs = '+'.join(c for f in formats for c in (f.get('vcodec'), f.get('acodec')) if c and c != 'none')
+        if transcode:
+            choice = f'transcode {codecs} -> {self.codec}'
+        elif extension != 'mp4' and not (result.get('acodec') or '').startswith(AUDIO_CODEC_PREFIXES.get(extension, ())):
+            choice = f'convert {codecs} -> {extension}'
+        else:
+            choice = f'remux {codecs} -> {extension}'
+        logging.info(f'YTD: フォーマット {result.get("format_id")} ({choice}) - {url}')
+        self.progress_content = f'[{choice}]'
+
+    def prefetch_with_aria2(self, ydl: yt_dlp.YoutubeDL, result: dict) -> None:
+        """選ばれたフォーマットを常駐aria2cで先に取得する。結合・後処理はyt-dlpに任せる"""
+        formats = result.get('requested_formats') or [result]
+        # HLSなどの分割配信はyt-dlpに任せる
+        if all(f.get('protocol') in ('http', 'https') for f in formats):
+            filename = ydl.prepare_filename(result)
+            for f in formats:
+                if result.get('requested_formats'):
+                    # yt-dlpが結合前の各フォーマットに付ける名前に合わせる
+                    fname = f'{os.path.splitext(filename)[0]}.f{f["format_id"]}.{f["ext"]}'
+                else:
+                    fname = filename
+                headers = dict(f.get('http_headers') or {})
+                cookie = ydl.cookiejar.get_cookie_header(f['url'])
+                if cookie:
+                    headers['Cookie'] = cookie
+                self.status_content = f'[downloading] {self.cnt}/{self.num} : {os.path.basename(fname)}'
+                # 取得済みのファイルはyt-dlpが飛ばすので、結合・後処理だけが行われる
+                aria2_daemon.download(f['url'], fname, headers, self)
+
+    def download_key(self, url: str) -> Optional[str]:
+        """メディアIDとフォーマット設定から決まるアイテムのキー。対応していないURLはNone"""
+        canonical = canonicalize_url(url)
+        if canonical is None:
+            return None
+        if self.extension == 'mp4':
+            profile = f'mp4/{self.resolution}/{self.codec}'
+        else:
+            # 音声は解像度・コーデック指定の影響を受けない
+            profile = self.extension
+        return f'{canonical[1]}|{profile}|thumbnail={self.thumbnail}|metadata={self.metadata}'
 
-        #self.progress_content = ''
+    def media_cache_key(self, url: str) -> Optional[str]:
+        """メディアキャッシュのキー。キャッシュしないURLはNone"""
+        if 'gigafile.nu' in url or any(sub in url for sub in self.streamlink_sites):
+            return None
+        return self.download_key(url)
 
     def my_hook(self, d: dict):
+        # 例外を投げるとyt-dlpのダウンロードが中断される
+        self.check_cancelled()
         try:
             title = os.path.basename(d['filename'])
             percent = self.remove_color_codes(d['_percent_str'])
@@ -1088,6 +2697,9 @@ class OptionModal(discord.ui.Modal):
         except Exception as e:
             self.status_content = f'[downloading] {self.cnt}/{self.num}'
 
+    def pp_hook(self, d: dict):
+        self.check_cancelled()
+
     def remove_color_codes(self, input_string: str) -> str:
         color_pattern = re.compile(r'\x1b\[[0-9;]*m')
         return color_pattern.sub('', input_string)
@@ -1099,27 +2711,122 @@ class OptionModal(discord.ui.Modal):
             'quiet': True,
             'no_warnings': True,
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.checkout(ydl_opts) as ydl:
             info_dict = ydl.extract_info(video_url, download=False)
             video_title = info_dict.get('title', None)
         return video_title
 
 
+class MultipartFileSlice:
+    """ファイルの一部を送るmultipart/form-dataの本文
+
+    本文全体をメモリに作らず、前後の区切り・ヘッダーは事前に作ったbytes、ファイル部分はmmapのmemoryviewで返す。
+    requestsにはファイルとして渡し、read()で少しずつ送らせる。
+    before_tailは末尾の区切りを返す前に呼ばれ、そこで待てばサーバー側でリクエストが完了するのを遅らせられる。
+    """
+    def __init__(self, path: str, start: int, size: int, fields: dict[str, str], on_read: Optional[Callable[[int], None]] = None, before_tail: Optional[Callable[[], None]] = None) -> None:
+        boundary = uuid.uuid4().hex
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        )
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="blob"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+
+        self.file = open(path, 'rb')
+        self.mmap = None
+        if size > 0:
+            # mmapの開始位置は割り当て単位の倍数にする
+            offset = start - start % mmap.ALLOCATIONGRANULARITY
+            self.mmap = mmap.mmap(self.file.fileno(), start - offset + size, offset=offset, access=mmap.ACCESS_READ)
+            body = memoryview(self.mmap)[start - offset:]
+        else:
+            body = memoryview(b'')
+        self.parts = [memoryview(head), body, memoryview(tail)]
+        self.length = len(head) + size + len(tail)
+        self.part = 0
+        self.pos = 0
+        self.on_read = on_read
+        self.before_tail = before_tail
+        # 送ったファイル部分のハッシュ。送り終えた時点でチャンクの内容のハッシュになる
+        self.digest = hashlib.sha256()
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, n: int = -1) -> memoryview:
+        while self.part < len(self.parts) and self.pos >= len(self.parts[self.part]):
+            self.part += 1
+            self.pos = 0
+        if self.part >= len(self.parts):
+            return memoryview(b'')
+        if self.part == len(self.parts) - 1 and self.before_tail is not None:
+            self.before_tail()
+            self.before_tail = None
+        view = self.parts[self.part]
+        end = len(view) if n is None or n < 0 else min(len(view), self.pos + n)
+        data = view[self.pos:end]
+        self.pos = end
+        if self.part == 1:
+            self.digest.update(data)
+        if self.on_read is not None:
+            self.on_read(len(data))
+        return data
+
+    def close(self) -> None:
+        try:
+            for view in self.parts:
+                view.release()
+            if self.mmap is not None:
+                try:
+                    self.mmap.close()
+                except BufferError:
+                    # 例外のトレースバックなどがread()で返したスライスをまだ持っている。
+                    # 元の例外を隠さないよう、ここでは閉じずに参照が無くなったときの解放に任せる
+                    pass
+                self.mmap = None
+        finally:
+            self.file.close()
+
+
+class GigaChunk:
+    """Gigaの1チャンク分のアップロード状態"""
+    def __init__(self, no: int, start: int, size: int, bar: Optional[tqdm]) -> None:
+        self.no = no
+        self.start = start
+        self.size = size
+        self.bar = bar
+        self.sent = 0
+
+
+class GigaUploadAborted(Exception):
+    """他のチャンクが失敗したため、このチャンクの送信をやめる"""
+
+
 class Giga:
-    def __init__(self, modal: OptionModal, path) -> None:
+    def __init__(self, modal: OptionModal, path, client: Optional['GigafileClient'] = None) -> None:
         self.modal = modal
         self.uri = path
         self.chunk_size = 1024*1024*10
         self.chunk_copy_size = 1024*1024
-        self.thread_num = 1
+        self.thread_num = GIGAFILE_UPLOAD_THREADS
+        self.lock = threading.Lock()
+        # 前のチャンクが受け付けられたら、順番待ちしているチャンクをすぐ起こす
+        self.turn = threading.Condition(self.lock)
         self.progress = True
         self.data = None
         self.pbar = None
         self.current_chunk = 0
-        self.aria2 = False
+        self.aria2 = aria2_daemon.available()
         self.total_uploaded = 0
-        self.session = self.requests_retry_session()
-        self.session.request = functools.partial(self.session.request, timeout=10)
+        self.client = client
+        if client is not None:
+            # アップロードは共有のクライアントの接続を使い回す
+            self.session = client.session
+        else:
+            self.session = self.requests_retry_session()
+            self.session.request = functools.partial(self.session.request, timeout=10)
 
     def bytes_to_size_str(self, bytes):
         if bytes == 0:
@@ -1147,144 +2854,222 @@ class Giga:
         return session
 
 
-    def split_file(self, input_file, out, target_size=None, start=0, chunk_copy_size=1024*1024):
-        input_file = Path(input_file)
-        size = 0
-
-        input_size = input_file.stat().st_size
-        if target_size is None:
-            output_size = input_size - start
-        else:
-            output_size = min( target_size, input_size - start)
-
-        with open(input_file, 'rb') as f:
-            f.seek(start)
-            while True:
-                # print(f'{size / output_size * 100:.2f}%', end='\r')
-                if size == output_size: break
-                if size > output_size:
-                    raise Exception(f'Size ({size}) is larger than {target_size} bytes!')
-                current_chunk_size = min(chunk_copy_size, output_size - size)
-                chunk = f.read(current_chunk_size)
-                if not chunk: break
-                size += len(chunk)
-                out.write(chunk)
-
-
     def upload_chunk(self, chunk_no, chunks):
-        self.chunk_no = chunk_no
-        self.bar = self.pbar[self.chunk_no % self.thread_num] if self.pbar else None
-        with io.BytesIO() as f:
-            self.split_file(self.uri, f, self.chunk_size, start=self.chunk_no * self.chunk_size, chunk_copy_size=self.chunk_copy_size)
-            chunk_size = f.tell()
-            f.seek(0)
-            fields = {
-                'id': self.token,
-                'name': Path(self.uri).name,
-                'chunk': str(self.chunk_no),
-                'chunks': str(chunks),
-                'lifetime': '100',
-                'file': ('blob', f, 'application/octet-stream'),
-            }
-            form_data = MultipartEncoder(fields)
-            headers = {
-                'content-type': form_data.content_type,
-            }
-            self.form_data_binary = form_data.to_string()
-            del form_data
-
-        self.size = len(self.form_data_binary)
-        if self.bar:
-            self.bar.desc = f'chunk {chunk_no + 1}/{chunks}'
-            self.bar.reset(total=self.size)
-            # bar.refresh()
+        if self.failed:
+            raise GigaUploadAborted()
+        # チャンクごとの状態はインスタンスに置かず、並列に送っても混ざらないようにする
+        start = chunk_no * self.chunk_size
+        chunk = GigaChunk(chunk_no, start, max(0, min(self.chunk_size, self.file_size - start)), self.pbar[chunk_no % self.thread_num] if self.pbar else None)
+        fields = {
+            'id': self.token,
+            'name': Path(self.uri).name,
+            'chunk': str(chunk.no),
+            'chunks': str(chunks),
+            'lifetime': '100',
+        }
 
-        while True:
+        for attempt in range(GIGAFILE_CHUNK_RETRIES + 1):
+            # 送信のたびにファイルから読み直すので、リトライしても本文をメモリに持たない
+            body = MultipartFileSlice(self.uri, chunk.start, chunk.size, fields, on_read=functools.partial(self.report_progress, chunk), before_tail=functools.partial(self.wait_turn, chunk))
+            if chunk.bar:
+                chunk.bar.desc = f'chunk {chunk_no + 1}/{chunks}'
+                chunk.bar.reset(total=len(body))
             try:
-                streamer = StreamingIterator(self.size, self.gen())
-                resp = self.session.post(f'https://{self.server}/upload_chunk.php', data=streamer, headers=headers)
+                resp = self.session.post(f'https://{self.server}/upload_chunk.php', data=body, headers={'content-type': body.content_type})
+                resp.raise_for_status()
+                resp_data = resp.json()
+            except (JobCancelled, GigaUploadAborted):
+                raise
             except Exception as e:
+                self.modal.check_cancelled()
+                with self.turn:
+                    # 送り直す分を進捗から引いておく
+                    self.total_uploaded -= chunk.sent
+                    chunk.sent = 0
+                    if attempt == GIGAFILE_CHUNK_RETRIES:
+                        # 待っている後続のチャンクを止める。受け付け済みのチャンクは残っているので次は続きから送れる
+                        self.failed = True
+                        self.error = e
+                        self.turn.notify_all()
+                        self.client.invalidate_server(self.server)
+                        raise
+                delay = random.uniform(0, min(GIGAFILE_RETRY_MAX_DELAY, GIGAFILE_RETRY_BASE_DELAY * 2 ** attempt))
                 print(e)
-                print('Retrying...')
+                print(f'Retrying chunk {chunk_no} in {delay:.1f}s...')
+                self.modal.cancelled.wait(delay)
+                self.modal.check_cancelled()
             else:
                 break
-
-        resp_data = resp.json()
-        self.current_chunk += 1
+            finally:
+                body.close()
 
         if 'url' in resp_data:
             self.data = resp_data
-        if 'status' not in resp_data or resp_data['status']:
+        ok = 'status' in resp_data and not resp_data['status']
+        # 次のチャンクを先に進めてから記録する。記録が後続より遅れても、再開時は先頭から連続した分しか使わない
+        with self.turn:
+            if not ok:
+                self.failed = True
+            self.current_chunk += 1
+            self.turn.notify_all()
+        if not ok:
             print(resp_data)
-            self.failed = True
-
-    def gen(self):
-        offset = 0
-        total_size = os.path.getsize(self.uri)  # chunk_sizesは各チャンクのサイズのリスト
-
-        while True:
-            if offset < self.size:
-                update_tick = 1024 * 128
-                yield self.form_data_binary[offset:offset+update_tick]
-                if self.bar:
-                    self.total_uploaded += min(update_tick, self.size - offset)
-                    percent = round(self.total_uploaded / total_size * 100, 1)
-                    uploaded_size = round((self.total_uploaded / 1048576), 2)
-                    total_size_MB = round((total_size / 1048576), 2)
-                    speed = 0 if self.bar.format_dict['rate'] == None else self.bar.format_dict['rate']
-                    speed_MB = round((speed / 1048576), 2)
-                    eta = timedelta(seconds=round((total_size - self.total_uploaded) / speed if speed and total_size else 0))
-                    self.modal.progress_content = f'{percent}% of {uploaded_size}/{total_size_MB} MiB at  {speed_MB}MiB/s  ETA {eta}'
-
-                    self.bar.update(min(update_tick, self.size - offset))
-                    self.bar.refresh()
-                offset += update_tick
+            self.client.invalidate_server(self.server)
+        if self.owns_record:
+            if not ok or 'url' in resp_data:
+                # 完了したか、サーバーに拒否されたトークンでは続きを送れないので捨てる
+                giga_upload_store.remove(self.upload_key)
             else:
-                if self.chunk_no != self.current_chunk:
-                    time.sleep(0.01)
-                else:
-                    time.sleep(0.1)
+                giga_upload_store.ack(self.upload_key, chunk_no, body.digest.hexdigest())
+
+    def report_progress(self, chunk: GigaChunk, n: int) -> None:
+        """送信した本文のバイト数を全チャンク合計の進捗に反映する"""
+        self.modal.check_cancelled()
+        with self.lock:
+            self.total_uploaded += n
+            chunk.sent += n
+            total_uploaded = self.total_uploaded
+            elapsed = time.time() - self.started
+        total_size = self.file_size
+        percent = round(total_uploaded / total_size * 100, 1) if total_size else 100
+        uploaded_size = round((total_uploaded / 1048576), 2)
+        total_size_MB = round((total_size / 1048576), 2)
+        # 並列に送っているので、チャンクごとではなく全体の平均速度を出す
+        speed = total_uploaded / elapsed if elapsed > 0 else 0
+        speed_MB = round((speed / 1048576), 2)
+        eta = timedelta(seconds=round((total_size - total_uploaded) / speed if speed and total_size > total_uploaded else 0))
+        self.modal.progress_content = f'{percent}% of {uploaded_size}/{total_size_MB} MiB at  {speed_MB}MiB/s  ETA {eta}'
+
+        if chunk.bar:
+            chunk.bar.update(n)
+
+    def wait_turn(self, chunk: GigaChunk) -> None:
+        """本文の最後を送る前に、前のチャンクがサーバーに受け付けられるまで待つ"""
+        with self.turn:
+            while chunk.no != self.current_chunk and not self.failed:
+                # 起こされるのは受け付け時。タイムアウトはキャンセルを確認するためだけ
+                self.turn.wait(GIGAFILE_CANCEL_CHECK_INTERVAL)
+                self.modal.check_cancelled()
+            if self.failed:
+                # 前のチャンクが失敗したので、順番を崩してサーバーに完了させないよう本文を送り切らない
+                raise GigaUploadAborted()
+
+    def chunk_digest(self, chunk_no: int) -> str:
+        """チャンクの内容のハッシュ。再開時に同じ内容か確かめるのに使う"""
+        start = chunk_no * self.chunk_size
+        remaining = max(0, min(self.chunk_size, self.file_size - start))
+        digest = hashlib.sha256()
+        with open(self.uri, 'rb') as f:
+            f.seek(start)
+            while remaining > 0:
+                data = f.read(min(self.chunk_copy_size, remaining))
+                if not data:
                     break
+                digest.update(data)
+                remaining -= len(data)
+        return digest.hexdigest()
+
+    def resume(self, chunks: int) -> int:
+        """保存済みのアップロードがあればトークンとサーバーを引き継ぎ、最初に送るチャンク番号を返す"""
+        saved = giga_upload_store.get(self.upload_key) if self.owns_record else None
+        if saved is not None:
+            token, server, chunk_size, saved_chunks, digests = saved
+            if chunk_size == self.chunk_size and saved_chunks == chunks:
+                # 完了はチャンク順なので、受け付け済みは先頭から連続している。内容が変わっていないところまで引き継ぐ
+                done = 0
+                while done < chunks and digests.get(done) == self.chunk_digest(done):
+                    done += 1
+                if 0 < done < chunks:
+                    self.token = token
+                    self.server = server
+                    self.resumed = True
+                    print(f'Resuming upload from chunk {done}/{chunks}')
+                    return done
+
+        self.resumed = False
+        self.token = uuid.uuid1().hex
+        self.server = self.client.server()
+        if self.owns_record:
+            giga_upload_store.start(self.upload_key, self.token, self.server, self.chunk_size, chunks)
+        return 0
 
     def upload(self):
-        self.token = uuid.uuid1().hex
         self.pbar = None
         self.failed = False
+        self.error = None
         assert Path(self.uri).exists()
         size = Path(self.uri).stat().st_size
+        self.file_size = size
+        self.started = time.time()
         chunks = math.ceil(size / self.chunk_size)
         print(f'Filesize {self.bytes_to_size_str(size)}, chunk size: {self.bytes_to_size_str(self.chunk_size)}, total chunks: {chunks}')
 
-        if self.progress:
-            self.pbar = []
-            for i in range(self.thread_num):
-                self.pbar.append(tqdm(total=size, unit='B', unit_scale=True, leave=False, unit_divisor=1024, ncols=100, position=i))
-
-        self.server = re.search(r'var server = "(.+?)"', self.session.get('https://gigafile.nu/').text)[1]
-
-        self.upload_chunk(0, chunks)
+        # 作り直したzipなどパスが変わっても同じ内容なら続きから送れるよう、内容で識別する
+        self.upload_key = hashlib.sha256(f'{size}:{self.chunk_size}:{self.chunk_digest(0)}'.encode()).hexdigest()
+        # 同じファイルを同時に送っているアップロードがあれば、その記録は引き継がず別のトークンで送る
+        self.owns_record = giga_upload_store.claim(self.upload_key)
+        try:
+            return self.send_chunks(chunks)
+        finally:
+            if self.owns_record:
+                giga_upload_store.release(self.upload_key)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as ex:
-            futures = {ex.submit(self.upload_chunk, i, chunks): i for i in range(1, chunks)}
-            try:
-                for future in concurrent.futures.as_completed(futures):
-                    if self.failed:
-                        print('Failed!')
-                        for future in futures:
-                            future.cancel()
-                        return
-            except KeyboardInterrupt:
-                print('\nUser cancelled the operation.')
-                for future in futures:
-                    future.cancel()
-                return
+    def send_chunks(self, chunks: int):
+        size = self.file_size
+        first_chunk = self.resume(chunks)
+        self.current_chunk = first_chunk
+        self.total_uploaded = min(size, first_chunk * self.chunk_size)
 
-        if self.pbar:
-            for bar in self.pbar:
-                bar.close()
+        try:
+            if self.progress:
+                self.pbar = []
+                for i in range(self.thread_num):
+                    self.pbar.append(tqdm(total=size, unit='B', unit_scale=True, leave=False, unit_divisor=1024, ncols=100, position=i))
+
+            # 最初のチャンクで受け付けてもらってから残りを並列に送る。完了順はwait_turnで揃え、最後のチャンクが最後になる
+            # 続きから送るときはサーバー側に受け付け済みなので、最初から並列に送る
+            if first_chunk == 0:
+                self.upload_chunk(0, chunks)
+                first_chunk = 1
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as ex:
+                futures = {ex.submit(self.upload_chunk, i, chunks): i for i in range(first_chunk, chunks)}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        if self.modal.cancelled.is_set():
+                            for future in futures:
+                                future.cancel()
+                            self.modal.check_cancelled()
+                        try:
+                            future.result()
+                        except GigaUploadAborted:
+                            pass
+                        except Exception:
+                            for other in futures:
+                                other.cancel()
+                            raise
+                        if self.failed:
+                            print('Failed!')
+                            for future in futures:
+                                future.cancel()
+                            if self.error is not None:
+                                # 再送しきれなかったチャンクのエラー。呼び出し側で続きから送り直させる
+                                raise self.error
+                            # サーバーに拒否された。記録は捨ててあるので、呼び出し側で最初から送り直させる
+                            raise RuntimeError('gigafile rejected the upload')
+                except KeyboardInterrupt:
+                    print('\nUser cancelled the operation.')
+                    for future in futures:
+                        future.cancel()
+                    return
+        finally:
+            if self.pbar:
+                for bar in self.pbar:
+                    bar.close()
         print('')
-        if 'url' not in self.data:
-            print('Something went wrong. Upload failed.', self.data)
+        if self.failed or not self.data or 'url' not in self.data:
+            # チャンクが1つだけで拒否された場合などもここで失敗にする
+            raise RuntimeError(f'gigafile upload failed: {self.data}')
         return self
 
     def get_download_page(self):
@@ -1324,10 +3109,7 @@ class Giga:
         download_url = self.uri.rsplit('/', 1)[0] + '/download.php?file=' + file_id
         if self.aria2:
             cookie_str = '; '.join([f'{cookie.name}={cookie.value}' for cookie in self.session.cookies])
-            cmd = ['aria2c', download_url, '--header', f'Cookie: {cookie_str}', '-o', filename]
-            cmd.extend(self.aria2.split(' '))
-            run(cmd)
-            return
+            return aria2_daemon.download(download_url, filename, {'Cookie': cookie_str}, self.modal)
 
         temp = filename + '.dl'
 
@@ -1339,6 +3121,7 @@ class Giga:
                 self.pbar = tqdm(total=filesize, unit='B', unit_scale=True, unit_divisor=1024, desc=desc)
             with open(temp, 'wb') as f:
                 for chunk in r.iter_content(chunk_size=self.chunk_copy_size):
+                    self.modal.check_cancelled()
                     f.write(chunk)
                     if self.pbar:
                         self.pbar.update(len(chunk))
@@ -1355,11 +3138,77 @@ class Giga:
         return filename
 
 
+class GigafileClient:
+    """プロセス全体で共有するgigafileへのアップロード用クライアント
+
+    keep-aliveの接続プールを全アップロードで使い回し、アップロード先サーバーはTTL付きでキャッシュして失敗したら調べ直す。
+    アップロードは専用のスレッドで動かすので、イベントループからはupload()をawaitするだけでよい。
+    """
+    def __init__(self, server_ttl: float, max_uploads: int) -> None:
+        self.server_ttl = server_ttl
+        self.lock = threading.Lock()
+        self.cached_server: Optional[str] = None
+        self.server_fetched = 0.0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_uploads, thread_name_prefix='gigafile')
+
+        # 同時に送るチャンクの分だけ接続を残しておく
+        pool_size = max_uploads * GIGAFILE_UPLOAD_THREADS
+        retry = Retry(total=5, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.request = functools.partial(self.session.request, timeout=10)
+
+    def server(self) -> str:
+        """アップロード先のサーバー。キャッシュが古ければトップページから調べ直す"""
+        with self.lock:
+            if self.cached_server is None or time.time() - self.server_fetched > self.server_ttl:
+                self.cached_server = re.search(r'var server = "(.+?)"', self.session.get('https://gigafile.nu/').text)[1]
+                self.server_fetched = time.time()
+            return self.cached_server
+
+    def invalidate_server(self, server: str) -> None:
+        """失敗したサーバーを次のアップロードでは使わないようにする"""
+        with self.lock:
+            if self.cached_server == server:
+                self.cached_server = None
+
+    async def upload(self, modal: OptionModal, path: str) -> Optional[str]:
+        """pathをアップロードしてダウンロードページのURLを返す"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(GIGAFILE_UPLOAD_ATTEMPTS):
+            gigafile = Giga(modal, path, self)
+            try:
+                await loop.run_in_executor(self.executor, gigafile.upload)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                if attempt == GIGAFILE_UPLOAD_ATTEMPTS - 1:
+                    raise
+                # 受け付け済みのチャンクは保存してあるので、次は続きから送る
+                logging.warning(f'YTD: gigafileへのアップロードに失敗、続きから再試行します: {e}')
+            else:
+                break
+
+        return gigafile.get_download_page()
+
+
+gigafile_client = GigafileClient(GIGAFILE_SERVER_TTL, max(1, WORKER_NUM))
+
+
 @bot.event
 async def on_ready():
     main = Main(bot)
     await bot.add_cog(main)
+    # 再開するジョブの作業ディレクトリは残しておく
+    workspace_manager.cleanup_orphans(keep=tuple(row[0] for row in job_store.pending_jobs()))
+    workspace_manager.cleanup_stale_partials(PARTIAL_MAX_AGE)
+    giga_upload_store.cleanup()
+    await main.restore_queue()
     await main.start_queue_processor()
     await main.bot.tree.sync(guild=discord.Object(id=GUILD_ID))
 
-bot.run(TOKEN)
\ No newline at end of file
+# 他のモジュールから読み込まれた場合はbotを起動しない
+if __name__ == '__main__':
+    bot.run(TOKEN)
\ No newline at end of file